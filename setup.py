@@ -9,7 +9,7 @@ def read(name, encoding="ascii"):
 
 
 REQUIREMENTS = [
-    "slack-sdk>=3.12.0",
+    "slack-sdk>=3.19.0",
     "slackeventsapi>=3.0.0",
     "aiohttp",
     "markdown>=3.3.6",
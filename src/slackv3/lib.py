@@ -1,4 +1,12 @@
+import logging
+import os
 import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
 
 USER_IS_BOT_HELPTEXT = (
     "Connected to Slack using a bot account, which cannot manage "
@@ -15,6 +23,18 @@ USER_IS_BOT_HELPTEXT = (
 # token matching this regex.
 SLACK_CLIENT_CHANNEL_HYPERLINK = re.compile(r"^<#(?P<id>([CG])[0-9A-Z]+)>$")
 
+# Slack formatted URIs, with and without a label, e.g.
+# <mailto:example@example.org|example@example.org> and <http://example.org>
+SLACK_LABELLED_URI = re.compile(r"<([^#][^|>]+)\|([^|>]+)>")
+SLACK_BARE_URI = re.compile(r"<(http([^>]+))>")
+
+# User or channel mentions, e.g. <@U12345> or <#C12345|channel>
+SLACK_MENTION = re.compile(r"<[@#][^>]*>*")
+
+# First character of Slack user/bot ids and channel ids.
+USER_ID_PREFIXES = frozenset("UBW")
+CHANNEL_ID_PREFIXES = frozenset("CGD")
+
 COLORS = {
     "red": "#FF0000",
     "green": "#008000",
@@ -35,3 +55,175 @@ class SlackAPIResponseError(RuntimeError):
         """
         self.error = error
         super().__init__(*args, **kwargs)
+
+
+def paginate(api_method, prefetch=False, **kwargs):
+    """
+    Yield each page returned by a cursor-paginated Slack API method.
+
+    Pagination stops after the last page or the first error response.  With
+    `prefetch`, the next page is requested in the background while the caller
+    processes the current one.  Only use it for callers that walk every page, a
+    caller stopping early would discard the page already being fetched.
+    """
+    if not prefetch:
+        cursor = None
+        while True:
+            res = api_method(cursor=cursor, **kwargs)
+            yield res
+            if not res["ok"]:
+                return
+            cursor = res.get("response_metadata", {}).get("next_cursor", "")
+            if not cursor:
+                return
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="slackv3-page")
+    try:
+        future = executor.submit(api_method, cursor=None, **kwargs)
+        while future is not None:
+            res = future.result()
+            cursor = ""
+            if res["ok"]:
+                cursor = res.get("response_metadata", {}).get("next_cursor", "")
+            future = None
+            if cursor:
+                future = executor.submit(api_method, cursor=cursor, **kwargs)
+            yield res
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def ttl_from_env(name, default):
+    """
+    Read a cache time-to-live (in seconds) from the environment variable `name`,
+    falling back to `default` when it is unset or invalid.
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        log.warning(f"Ignoring invalid value '{value}' for {name}, using {default}.")
+        return default
+
+
+class TTLCache:
+    """
+    Thread-safe cache of Slack API lookups with stale-while-revalidate semantics.
+
+    Entries younger than `ttl` are returned as-is.  Entries younger than `stale_ttl`
+    are returned immediately while a refresh is scheduled in the background.  Older
+    or missing entries are loaded synchronously by calling `loader()`; concurrent
+    callers missing the same key wait for that single load.  A loader returning None
+    signals a failed lookup, which is never cached.
+    """
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, ttl, stale_ttl=None, maxsize=1024):
+        self.ttl = ttl
+        self.stale_ttl = ttl if stale_ttl is None else max(ttl, stale_ttl)
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _refresh_executor(cls):
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=4, thread_name_prefix="slackv3-cache"
+                )
+            return cls._executor
+
+    def get(self, key, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < self.ttl:
+                return entry[1]
+            if age < self.stale_ttl:
+                self._schedule_refresh(key, loader)
+                return entry[1]
+        return self._load(key, loader)
+
+    def peek(self, key):
+        """
+        Return the cached value of key, or None when there is none or it has expired.
+        Unlike get(), this never loads, schedules a refresh or waits for a load.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] >= self.stale_ttl:
+            return None
+        return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            # A load in flight for the key would overwrite this newer value.
+            self._loading.pop(key, None)
+            self._store(key, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._loading.pop(key, None)
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._loading.clear()
+            self._entries.clear()
+
+    def _store(self, key, value):
+        # Called with self._lock held.
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _load(self, key, loader):
+        with self._lock:
+            pending = self._loading.get(key)
+            waiting = pending is not None
+            if not waiting:
+                pending = self._loading[key] = Future()
+        if waiting:
+            return pending.result()
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                if self._loading.get(key) is pending:
+                    del self._loading[key]
+            pending.set_exception(e)
+            raise
+        with self._lock:
+            # set(), invalidate() and clear() drop the pending load, its value is
+            # then outdated and only returned to the callers already waiting for it.
+            if self._loading.get(key) is pending:
+                del self._loading[key]
+                if value is not None:
+                    self._store(key, value)
+        pending.set_result(value)
+        return value
+
+    def _schedule_refresh(self, key, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        self._refresh_executor().submit(self._refresh, key, loader)
+
+    def _refresh(self, key, loader):
+        try:
+            self._load(key, loader)
+        except Exception:
+            log.exception(f"Background refresh of cache entry {key} failed.")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
@@ -31,6 +31,4 @@ class LinkPreProcessor(Preprocessor):
     """
 
     def run(self, lines):
-        for i, line in enumerate(lines):
-            lines[i] = MARKDOWN_LINK_REGEX.sub(r"&lt;\2|\1&gt;", line)
-        return lines
+        return [MARKDOWN_LINK_REGEX.sub(r"&lt;\2|\1&gt;", line) for line in lines]
@@ -1,10 +1,86 @@
 import logging
+import threading
 
 from errbot.backends.base import Person, RoomDoesNotExistError
 from slack_sdk.web import WebClient
 
+from .lib import (
+    CHANNEL_ID_PREFIXES,
+    USER_ID_PREFIXES,
+    SlackAPIResponseError,
+    TTLCache,
+    paginate,
+    ttl_from_env,
+)
+
 log = logging.getLogger(__name__)
 
+# User and channel details shared by every SlackPerson instance, keyed by Slack ID.
+USER_INFO_CACHE = TTLCache(
+    ttl=ttl_from_env("SLACKV3_USER_INFO_TTL", 300),
+    stale_ttl=ttl_from_env("SLACKV3_USER_INFO_STALE_TTL", 3600),
+)
+CHANNEL_INFO_CACHE = TTLCache(
+    ttl=ttl_from_env("SLACKV3_CHANNEL_INFO_TTL", 300),
+    stale_ttl=ttl_from_env("SLACKV3_CHANNEL_INFO_STALE_TTL", 3600),
+)
+# Workspace wide user name to user ids index.
+USERS_INDEX_CACHE = TTLCache(
+    ttl=ttl_from_env("SLACKV3_USERS_INDEX_TTL", 300),
+    stale_ttl=ttl_from_env("SLACKV3_USERS_INDEX_STALE_TTL", 3600),
+    maxsize=1,
+)
+# Serialises in place updates of the cached users index.
+USERS_INDEX_LOCK = threading.Lock()
+
+
+def users_index(webclient: WebClient):
+    """
+    Return a dict mapping every Slack user name in the workspace to a tuple of
+    matching user ids.  The index is built from users.list and cached.
+    """
+    return USERS_INDEX_CACHE.get("users", lambda: _fetch_users_index(webclient))
+
+
+def forget_user(user, joined=False):
+    """
+    Drop the cached details of a user whose profile changed, given the user object
+    sent with the event, and file them under their current name in the users index.
+    The index is rebuilt on next use instead when the user `joined` the workspace.
+    """
+    userid = user["id"]
+    USER_INFO_CACHE.invalidate(userid)
+    name = user.get("name")
+    if joined or name is None:
+        USERS_INDEX_CACHE.invalidate("users")
+        return
+    index = USERS_INDEX_CACHE.peek("users")
+    if index is None:
+        return
+    with USERS_INDEX_LOCK:
+        for old_name, user_ids in list(index.items()):
+            if old_name != name and userid in user_ids:
+                remaining = tuple(i for i in user_ids if i != userid)
+                if remaining:
+                    index[old_name] = remaining
+                else:
+                    del index[old_name]
+        if userid not in index.get(name, ()):
+            index[name] = index.get(name, ()) + (userid,)
+
+
+def _fetch_users_index(webclient: WebClient):
+    index = {}
+    for res in paginate(webclient.users_list, limit=1000, prefetch=True):
+        if not res["ok"]:
+            raise SlackAPIResponseError(
+                f"Unable to list users.  Slack error: {res['error']}",
+                error=res["error"],
+            )
+        for user in res["members"]:
+            index[user["name"]] = index.get(user["name"], ()) + (user["id"],)
+    return index
+
 
 class SlackPerson(Person):
     """
@@ -28,29 +104,26 @@ class SlackPerson(Person):
     """
 
     def __init__(self, webclient: WebClient, userid=None, channelid=None):
-        if userid is not None and userid[0] not in ("U", "W", "B"):
+        if userid is not None and userid[0] not in USER_ID_PREFIXES:
             raise Exception(
                 f"This is not a Slack user or bot id: {userid} "
                 "(should start with B, U or W)"
             )
 
-        if channelid is not None and channelid[0] not in ("D", "C", "G"):
+        if channelid is not None and channelid[0] not in CHANNEL_ID_PREFIXES:
             raise Exception(
                 f"This is not a valid Slack channelid: {channelid} "
                 "(should start with D, C or G)"
             )
 
         self._userid = userid
+        self._hash = hash(userid)
+        self._str = None
         self._user_info = {}
         self._channelid = channelid
         self._channel_info = {}
         self._webclient = webclient
 
-        if self._userid is not None:
-            self._cache_user_info()
-        if self._channelid is not None:
-            self._cache_channel_info()
-
     @property
     def userid(self):
         """
@@ -63,16 +136,22 @@ class SlackPerson(Person):
         """
         Convert a Slack user ID to their display name.
         """
+        if not self._user_info:
+            self._cache_user_info()
         return self._user_info.get("display_name", "")
 
     @property
     def fullname(self):
         """Convert a Slack user ID to their full name"""
+        if not self._user_info:
+            self._cache_user_info()
         return self._user_info.get("real_name", "")
 
     @property
     def email(self):
         """Convert a Slack user ID to their user email"""
+        if not self._user_info:
+            self._cache_user_info()
         return self._user_info.get("email", "")
 
     def _cache_user_info(self):
@@ -89,44 +168,58 @@ class SlackPerson(Person):
         if len(self._userid) <= 3:
             return
 
+        user_info = USER_INFO_CACHE.get(self._userid, self._fetch_user_info)
+        if user_info is not None:
+            self._user_info = user_info
+        return self._user_info
+
+    def _fetch_user_info(self):
+        """
+        Fetch user info from Slack.
+
+        :return: the user info or None when the user can't be found.
+        """
         if self._userid[0] == "B":
             res = self._webclient.bots_info(bot=self._userid)
         else:
             res = self._webclient.users_info(user=self._userid)
 
-        if res["ok"] is False:
+        if not res["ok"]:
             log.error(
                 f"Cannot find user with ID {self._userid}. Slack Error: {res['error']}"
             )
+            return None
+
+        user_info = {}
+        if "bot" in res:
+            user_info["display_name"] = res["bot"].get("name", "")
         else:
-            if "bot" in res:
-                self._user_info["display_name"] = res["bot"].get("name", "")
+            user = res["user"]
+            profile = user["profile"]
+            for attribute in ["real_name", "display_name", "email"]:
+                user_info[attribute] = profile.get(attribute, "")
+
+            team = None
+            # Normal users
+            if user.get("team_id"):
+                team = user["team_id"]
+            # Users in a ORG/grid setup do not have a team ID
+            elif user.get("enterprise_user"):
+                team = user["enterprise_user"].get("enterprise_id")
             else:
-                for attribute in ["real_name", "display_name", "email"]:
-                    self._user_info[attribute] = res["user"]["profile"].get(
-                        attribute, ""
-                    )
+                log.warning(
+                    f"Failed to find team_id or enterprise_user details for userid {self._userid}."
+                )
 
-                team = None
-                # Normal users
-                if res.get("user").get("team_id"):
-                    team = res["user"]["team_id"]
-                # Users in a ORG/grid setup do not have a team ID
-                elif res.get("user", {}).get("enterprise_user"):
-                    team = res["user"]["enterprise_user"].get("enterprise_id")
+            if team:
+                team_res = self._webclient.team_info(team=team)
+                if team_res["ok"]:
+                    user_info["domain"] = team_res["team"]["domain"]
                 else:
                     log.warning(
-                        f"Failed to find team_id or enterprise_user details for userid {self._userid}."
+                        f"Failed to fetch team information for userid {self._userid}. Slack error {team_res['error']}"
                     )
-
-                if team:
-                    team_res = self._webclient.team_info(team=team)
-                    if team_res["ok"]:
-                        self._user_info["domain"] = team_res["team"]["domain"]
-                    else:
-                        log.warning(
-                            f"Failed to fetch team information for userid {self._userid}. Slack error {team_res['ok']}"
-                        )
+        return user_info
 
     @property
     def channelid(self):
@@ -137,6 +230,7 @@ class SlackPerson(Person):
         """
         Convert a Slack channel ID to its channel name
         """
+        self._cache_channel_info()
         channel_name_key = "name"
         if self._channel_info.get("is_im") is True:
             channel_name_key = "user"
@@ -152,21 +246,36 @@ class SlackPerson(Person):
             raise ValueError("Unable to lookup an undefined channel id.")
 
         if self._channel_info.get("id") is None or refresh:
-            res = self._webclient.conversations_info(channel=self.channelid)
-            if res["ok"] is False:
-                raise RoomDoesNotExistError(
-                    f"No channel with ID {self._channelid} exists.  Slack error {res['error']}"
-                )
-            if res["channel"]["id"] != self._channelid:
-                raise ValueError(
-                    "Inconsistent data detected.  "
-                    f"{res['channel']['id']} does not equal {self._channelid}"
-                )
-            for attribute in ["name", "user", "is_im", "is_mpim", "id"]:
-                self._channel_info[attribute] = res["channel"].get(attribute)
+            if refresh:
+                CHANNEL_INFO_CACHE.invalidate(self._channelid)
+            self._channel_info = CHANNEL_INFO_CACHE.get(
+                self._channelid, self._fetch_channel_info
+            )
+
+    def _fetch_channel_info(self):
+        """
+        Fetch channel info from Slack.
+        """
+        res = self._webclient.conversations_info(channel=self._channelid)
+        if not res["ok"]:
+            raise RoomDoesNotExistError(
+                f"No channel with ID {self._channelid} exists.  Slack error {res['error']}"
+            )
+        channel = res["channel"]
+        if channel["id"] != self._channelid:
+            raise ValueError(
+                "Inconsistent data detected.  "
+                f"{channel['id']} does not equal {self._channelid}"
+            )
+        return {
+            attribute: channel.get(attribute)
+            for attribute in ["name", "user", "is_im", "is_mpim", "id"]
+        }
 
     @property
     def domain(self):
+        if not self._user_info:
+            self._cache_user_info()
         return self._user_info.get("domain", "")
 
     # Compatibility with the generic API.
@@ -184,16 +293,22 @@ class SlackPerson(Person):
     person = aclattr
 
     def __unicode__(self):
-        return f"<@{self.aclattr}>"
+        # The representation only depends on the immutable id, format it once.
+        if self._str is None:
+            self._str = f"<@{self.aclattr}>"
+        return self._str
 
     def __str__(self):
         return self.__unicode__()
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if not isinstance(other, SlackPerson):
             log.warning(f"tried to compare a SlackPerson with a {type(other)}")
             return False
-        return other.userid == self.userid
+        # Different cached hashes can never be equal ids, skip the string compare.
+        return other._hash == self._hash and other._userid == self._userid
 
     def __hash__(self):
-        return self.userid.__hash__()
+        return self._hash
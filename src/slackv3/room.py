@@ -1,5 +1,7 @@
 import logging
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from errbot.backends.base import (
     Room,
@@ -9,11 +11,39 @@ from errbot.backends.base import (
     UserDoesNotExistError,
 )
 
-from .lib import USER_IS_BOT_HELPTEXT, SlackAPIResponseError
-from .person import SlackPerson
+from .lib import (
+    USER_IS_BOT_HELPTEXT,
+    SlackAPIResponseError,
+    TTLCache,
+    paginate,
+    ttl_from_env,
+)
+from .person import CHANNEL_INFO_CACHE, SlackPerson, users_index
 
 log = logging.getLogger(__name__)
 
+# Channel name to channel id resolutions, shared by every SlackRoom instance.
+CHANNEL_ID_CACHE = TTLCache(ttl=ttl_from_env("SLACKV3_CHANNEL_ID_TTL", 3600))
+# Channel details shared by every SlackRoom instance, keyed by channel id.
+ROOM_INFO_CACHE = TTLCache(
+    ttl=ttl_from_env("SLACKV3_ROOM_INFO_TTL", 30),
+    stale_ttl=ttl_from_env("SLACKV3_ROOM_INFO_STALE_TTL", 300),
+)
+# Channel names that matched no channel, remembered briefly so lookups of an unknown
+# name don't list every channel each time.
+MISSING_CHANNEL_CACHE = TTLCache(ttl=ttl_from_env("SLACKV3_MISSING_CHANNEL_TTL", 60))
+# Channel ids conversations.info reported as not found (deleted or inaccessible
+# channels), remembered briefly so every access doesn't retry the call.
+MISSING_ROOM_CACHE = TTLCache(ttl=ttl_from_env("SLACKV3_MISSING_ROOM_TTL", 60))
+
+# Maximum number of users conversations.invite accepts in one call.
+INVITE_BATCH_SIZE = 1000
+
+# Conversation types searched separately when resolving a channel name.  Slack
+# filters types after fetching a page, so a single type needs fewer, fuller pages.
+# Direct messages have no name and are never searched.
+CHANNEL_NAME_SEARCH_TYPES = ("public_channel", "private_channel", "mpim")
+
 try:
     from slack_sdk.errors import BotUserAccessError, SlackApiError
     from slack_sdk.web import WebClient
@@ -26,6 +56,22 @@ except ImportError:
     sys.exit(1)
 
 
+def forget_channel(channelid, name=None):
+    """
+    Drop the cached details of a channel that was renamed, archived or deleted.
+    When the channel's new `name` is known its resolution is remembered instead.
+    """
+    channel_info = ROOM_INFO_CACHE.peek(channelid)
+    if channel_info is not None:
+        CHANNEL_ID_CACHE.invalidate(channel_info["name"])
+    ROOM_INFO_CACHE.invalidate(channelid)
+    MISSING_ROOM_CACHE.invalidate(channelid)
+    CHANNEL_INFO_CACHE.invalidate(channelid)
+    if name is not None:
+        CHANNEL_ID_CACHE.set(name, channelid)
+        MISSING_CHANNEL_CACHE.invalidate(name)
+
+
 class SlackRoom(Room):
     def __init__(self, webclient=None, name=None, channelid=None, bot=None):
         if channelid is not None and name is not None:
@@ -35,7 +81,8 @@ class SlackRoom(Room):
 
         self._bot = bot
         self._webclient = webclient
-        self._cache = None
+        self._id = channelid
+        self._name = None
 
         if name is not None:
             if name.startswith("#"):
@@ -43,84 +90,146 @@ class SlackRoom(Room):
             else:
                 self._name = name
 
-            # channelid = self._channelname_to_id(name)
             try:
-                channelid = self._channelname_to_id(name)
+                self._id = self._channelname_to_id(self._name)
             except RoomDoesNotExistError:
                 pass
 
-        if channelid:
-            self._cache_channel_info(channelid)
-
     def __str__(self):
-        return f"<#{self.id}|{self.name}>"
-
-    @property
-    def channelname(self):
-        return self._cache["name"]
+        return self.channelid
 
     def _channelname_to_id(self, name):
         """
         Resolve channel name to channel id.
         """
-        log.debug(f"Resolving channel '{name}' by iterating all channels")
-        channel_id = None
-        cursor = None
-        while channel_id is None and cursor != "":
-            res = self._webclient.conversations_list(
-                cursor=cursor,
-                limit=1000,
-                types="public_channel,private_channel,mpim,im",
-            )
+        channel_id = CHANNEL_ID_CACHE.get(name, lambda: self._find_channel_id(name))
+        if channel_id is None:
+            raise RoomDoesNotExistError(f"Cannot find channel {name}.")
+        return channel_id
 
-            if res["ok"] is True:
-                for channel in res["channels"]:
-                    if "name" in channel and channel["name"] == name:
-                        channel_id = channel["id"]
-                        break
-                else:
-                    cursor = res["response_metadata"].get("next_cursor", "")
-            else:
-                log.exception(f"Unable to list channels.  Slack error {res['error']}")
+    def _find_channel_id(self, name):
+        """
+        Find a channel id by walking the list of all channels.
+        Returns None when no channel matches the name.
+        """
+        if MISSING_CHANNEL_CACHE.peek(name):
+            return None
+        log.debug("Resolving channel '%s' by iterating all channels", name)
+        # Public channels are the usual match so they are searched on their own
+        # first, the remaining types are then searched concurrently.
+        first_type, *other_types = CHANNEL_NAME_SEARCH_TYPES
+        found = threading.Event()
+        try:
+            channel_id = self._search_channel_type(name, first_type, found)
+            if channel_id is None and other_types:
+                with ThreadPoolExecutor(
+                    max_workers=len(other_types), thread_name_prefix="slackv3-channels"
+                ) as executor:
+                    futures = [
+                        executor.submit(self._search_channel_type, name, t, found)
+                        for t in other_types
+                    ]
+                    for future in as_completed(futures):
+                        channel_id = future.result()
+                        if channel_id is not None:
+                            break
+        except SlackAPIResponseError as e:
+            log.exception("Unable to list channels.  Slack error %s", e.error)
+            return None
 
         if channel_id is None:
-            raise RoomDoesNotExistError(f"Cannot find channel {name}.")
-        log.debug(f"Channel '{name}' resolved to channel id '{channel_id}'")
+            MISSING_CHANNEL_CACHE.set(name, True)
         return channel_id
 
-    def _cache_channel_info(self, channelid):
+    def _search_channel_type(self, name, channel_type, found):
+        """
+        Walk the conversations of one type looking for name.  Stops early once
+        `found` is set by a concurrent search of another type.  Pages are requested
+        one at a time, so stopping early leaves no page request wasted.
+        """
+        for res in paginate(
+            self._webclient.conversations_list, limit=1000, types=channel_type
+        ):
+            if not res["ok"]:
+                raise SlackAPIResponseError(error=res["error"])
+            # Index every named channel seen so later lookups are dict hits.
+            channel_id = None
+            for channel in res["channels"]:
+                if "name" in channel:
+                    CHANNEL_ID_CACHE.set(channel["name"], channel["id"])
+                    if channel["name"] == name:
+                        channel_id = channel["id"]
+            if channel_id is not None:
+                log.debug("Channel '%s' resolved to channel id '%s'", name, channel_id)
+                found.set()
+                return channel_id
+            if found.is_set():
+                break
+        return None
+
+    def _fetch_channel_info(self, channelid):
         """
-        Channel info as returned by the Slack API.
+        Channel info as returned by the Slack API, or None when it can't be fetched.
         Reference:
             https://api.slack.com/methods/conversations.info
         """
-        res = self._webclient.conversations_info(channel=channelid)
-        if res["ok"] is True:
-            channel = res["channel"]
-            self._cache = {
-                "id": channel["id"],
-                "name": channel["name"],
-                "topic": channel["topic"]["value"],
-                "purpose": channel["purpose"]["value"],
-                "is_private": channel.get("is_private", None),
-                "is_im": channel.get("is_im", None),
-                "is_mpim": channel.get("is_mpim", None),
-            }
-        else:
-            log.exception(
-                f"Failed to fetch information for channel id {channelid}."
-                f"  Slack error {res['error']}"
+        if MISSING_ROOM_CACHE.peek(channelid):
+            return None
+        try:
+            res = self._webclient.conversations_info(channel=channelid)
+        except SlackApiError as e:
+            # Only a missing channel is remembered, other errors may be transient.
+            if e.response.get("error") != "channel_not_found":
+                raise
+            res = e.response
+        if not res["ok"]:
+            log.error(
+                "Failed to fetch information for channel id %s.  Slack error %s",
+                channelid,
+                res["error"],
             )
+            if res["error"] == "channel_not_found":
+                MISSING_ROOM_CACHE.set(channelid, True)
+            return None
+        channel = res["channel"]
+        # Channels are looked up by name too, remember the resolution.
+        CHANNEL_ID_CACHE.set(channel["name"], channel["id"])
+        return {
+            "id": channel["id"],
+            "name": channel["name"],
+            "topic": channel["topic"]["value"],
+            "purpose": channel["purpose"]["value"],
+            "is_private": channel.get("is_private", None),
+            "is_im": channel.get("is_im", None),
+            "is_mpim": channel.get("is_mpim", None),
+        }
+
+    @property
+    def _channel_info(self):
+        """
+        Channel info fetched from Slack on first use and shared by every SlackRoom
+        of the channel through ROOM_INFO_CACHE.
+        """
+        if self._id is None:
+            raise RoomDoesNotExistError(f"Channel {self._name} does not exist.")
+        channel_info = ROOM_INFO_CACHE.get(
+            self._id, lambda: self._fetch_channel_info(self._id)
+        )
+        if channel_info is None:
+            raise RoomDoesNotExistError(f"No channel with ID {self._id} exists.")
+        return channel_info
 
     @property
     def private(self):
         """Return True if the room is a private group"""
-        return self._cache["is_private"]
+        return self._channel_info["is_private"]
 
     @property
     def id(self):
         """Return the ID of this room"""
-        return self._cache["id"]
+        if self._id is None:
+            return self._channel_info["id"]
+        return self._id
 
     aclattr = id
 
@@ -132,148 +241,173 @@ class SlackRoom(Room):
     @property
     def name(self):
         """Return the name of this room"""
-        return self._cache["name"]
+        if self._name is not None:
+            return self._name
+        return self._channel_info["name"]
+
+    channelname = name
 
     def join(self, username=None, password=None):
-        log.info(f"Joining channel '{self.name}'")
+        log.info("Joining channel '%s'", self.name)
         join_failure = True
         try:
             self._webclient.conversations_join(channel=self.id)
             join_failure = False
         except SlackApiError as e:
-            log.error(f"Unable to join '{self.name}'. Slack API Error {str(e)}")
+            log.error("Unable to join '%s'. Slack API Error %s", self.name, e)
         except BotUserAccessError:
-            log.error(f"OAuthv1 bot token not allowed to join channels. '{self.name}'.")
+            log.error(
+                "OAuthv1 bot token not allowed to join channels. '%s'.", self.name
+            )
 
         if join_failure:
             raise RoomError(f"Unable to join channel. {USER_IS_BOT_HELPTEXT}")
 
     def leave(self, reason=None):
         try:
-            log.info(f"Leaving conversation {self} ({self.id})")
+            log.info("Leaving conversation %s (%s)", self, self.id)
             self._bot.slack_web.conversations_leave(channel=self.id)
         except SlackAPIResponseError as e:
             if e.error == "user_is_bot":
                 raise RoomError(f"Unable to leave channel. {USER_IS_BOT_HELPTEXT}")
             else:
                 raise RoomError(e)
-        self._id = None
+        ROOM_INFO_CACHE.invalidate(self.id)
 
     def create(self, private=False):
         try:
             if private:
-                log.info(f"Creating private conversation {self}.")
-                self._bot.slack_web.conversations_create(
+                log.info("Creating private conversation %s.", self.name)
+                res = self._bot.slack_web.conversations_create(
                     name=self.name, is_private=True
                 )
             else:
-                log.info(f"Creating conversation {self}.")
-                self._bot.slack_web.conversations_create(name=self.name)
+                log.info("Creating conversation %s.", self.name)
+                res = self._bot.slack_web.conversations_create(name=self.name)
         except SlackAPIResponseError as e:
             if e.error == "user_is_bot":
                 raise RoomError(f"Unable to create channel. {USER_IS_BOT_HELPTEXT}")
             else:
                 raise RoomError(e)
+        self._id = res["channel"]["id"]
+        # Drops any negative entries and remembers the new name's resolution.
+        forget_channel(self._id, self.name)
 
     def destroy(self):
         try:
-            log.info(f"Archiving conversation {self} ({self.id})")
+            log.info("Archiving conversation %s (%s)", self, self.id)
             self._bot.slack_web.conversations_archive(self.id)
         except SlackAPIResponseError as e:
             if e.error == "user_is_bot":
                 raise RoomError(f"Unable to archive channel. {USER_IS_BOT_HELPTEXT}")
             else:
                 raise RoomError(e)
-        self._id = None
+        ROOM_INFO_CACHE.invalidate(self.id)
+
+    def _in_channels(self, channels):
+        """
+        Return True if this room is one of channels, matching on the id when it is
+        known so a renamed channel is still found.
+        """
+        if self._id is not None:
+            return any(c["id"] == self._id for c in channels)
+        name = self.name
+        return any(c["name"] == name for c in channels)
 
     @property
     def exists(self):
-        channels = self._bot.channels(joined_only=False, exclude_archived=False)
-        return len([c for c in channels if c["name"] == self.name]) > 0
+        return self._in_channels(
+            self._bot.channels(joined_only=False, exclude_archived=False)
+        )
 
     @property
     def joined(self):
-        channels = self._bot.channels(joined_only=True)
-        return len([c for c in channels if c["name"] == self.name]) > 0
+        return self._in_channels(self._bot.channels(joined_only=True))
 
     @property
     def topic(self):
         """
         Return topic string or None when it's an empty string.
         """
-        topic = None
-        if self._cache:
-            topic = self._cache.get("topic")
-        return topic
+        try:
+            return self._channel_info.get("topic")
+        except RoomDoesNotExistError:
+            return None
 
     @topic.setter
     def topic(self, topic):
-        log.info(f"Setting topic of {self} ({self.id}) to {topic}.")
+        log.info("Setting topic of %s (%s) to %s.", self, self.id, topic)
         res = self._webclient.conversations_setTopic(channel=self.id, topic=topic)
-        if res["ok"] is True:
-            self._cache["topic"] = topic
+        if res["ok"]:
+            self._channel_info["topic"] = topic
         else:
-            log.error(f"Unable to set topic.  Slack error {res['error']}")
+            log.error("Unable to set topic.  Slack error %s", res["error"])
 
     @property
     def purpose(self):
-        return self._cache["purpose"] or None
+        return self._channel_info["purpose"] or None
 
     @purpose.setter
     def purpose(self, purpose):
-        log.info(f"Setting purpose of {self} ({self.id}) to {purpose}.")
+        log.info("Setting purpose of %s (%s) to %s.", self, self.id, purpose)
         res = self._webclient.conversations_setPurpose(channel=self.id, purpose=purpose)
-        if res["ok"] is True:
-            self._cache["purpose"] = purpose
+        if res["ok"]:
+            self._channel_info["purpose"] = purpose
         else:
-            log.error(f"Unable to set purpose.  Slack error {res['error']}")
+            log.error("Unable to set purpose.  Slack error %s", res["error"])
 
     @property
     def occupants(self):
-        occupants = []
-        cursor = None
-        while cursor != "":
-            res = self._webclient.conversations_members(
-                channel=self.id,
-                cursor=cursor,
-                limit=1000,
-            )
-            if res["ok"] is True:
-                for member in res["members"]:
-                    occupants.append(
-                        SlackRoomOccupant(self._webclient, member, self.id, self._bot)
-                    )
-                cursor = res["response_metadata"]["next_cursor"]
-            else:
+        members = []
+        for res in paginate(
+            self._webclient.conversations_members,
+            channel=self.id,
+            limit=1000,
+            prefetch=True,
+        ):
+            if not res["ok"]:
                 log.exception(
-                    f"Unable to fetch members in conversation {self.id}."
-                    f"  Slack error {res['error']}"
+                    "Unable to fetch members in conversation %s.  Slack error %s",
+                    self.id,
+                    res["error"],
                 )
-        return occupants
+                break
+            members.extend(res["members"])
+
+        # User details are fetched on first attribute access, through USER_INFO_CACHE.
+        return [
+            SlackRoomOccupant(self._webclient, member, self.id, self._bot, room=self)
+            for member in members
+        ]
 
     def invite(self, *args):
-        users = {
-            user["name"]: user["id"]
-            for user in self._webclient.api_call("users.list")["members"]
-        }
+        users = users_index(self._webclient)
 
+        user_ids = []
         for user in args:
             if user not in users:
                 raise UserDoesNotExistError(f'User "{user}" not found.')
-            log.info("Inviting %s into %s (%s)", user, self, self.id)
-            method = "conversations.invite"
-            response = self._bot.api_call(
-                method,
-                data={"channel": self.id, "user": users[user]},
-                raise_errors=False,
-            )
+            user_ids.append(users[user][0])
+
+        method = "conversations.invite"
+        for start in range(0, len(user_ids), INVITE_BATCH_SIZE):
+            batch = user_ids[start : start + INVITE_BATCH_SIZE]
+            log.info("Inviting %s into %s (%s)", ", ".join(batch), self, self.id)
+            try:
+                # force invites the valid users even when others in the batch fail.
+                response = self._webclient.conversations_invite(
+                    channel=self.id, users=",".join(batch), force=True
+                )
+                errors = response.get("errors") or []
+            except SlackApiError as e:
+                errors = e.response.get("errors") or [{"error": e.response["error"]}]
 
-            if not response["ok"]:
-                if response["error"] == "user_is_bot":
+            for error in errors:
+                if error["error"] == "user_is_bot":
                     raise RoomError(f"Unable to invite people. {USER_IS_BOT_HELPTEXT}")
-                elif response["error"] != "already_in_channel":
+                elif error["error"] != "already_in_channel":
                     raise SlackAPIResponseError(
-                        error=f'Slack API call to {method} failed: {response["error"]}.'
+                        error=f'Slack API call to {method} failed: {error["error"]}.'
                     )
 
     def __eq__(self, other):
@@ -282,14 +416,21 @@ class SlackRoom(Room):
         return self.id == other.id
 
 
-class SlackRoomOccupant(RoomOccupant, SlackPerson):
+def _shared_room(webclient, channelid, bot):
     """
-    This class represents a person inside a MUC.
+    Return the backend's SlackRoom for channelid so occupants of the same channel
+    share one instance (and its channel info) instead of building one each.
     """
+    if bot is None:
+        return SlackRoom(webclient=webclient, channelid=channelid)
+    return bot.get_room(channelid)
 
-    def __init__(self, webclient: WebClient, userid, channelid, bot):
-        super().__init__(webclient, userid, channelid)
-        self._room = SlackRoom(webclient=webclient, channelid=channelid, bot=bot)
+
+class _SlackOccupantMixin:
+    """
+    Behaviour shared by people and bots inside a MUC.  Subclasses store the room
+    in a `_room` attribute.
+    """
 
     @property
     def room(self):
@@ -302,14 +443,31 @@ class SlackRoomOccupant(RoomOccupant, SlackPerson):
         return self.__unicode__()
 
     def __eq__(self, other):
-        if not isinstance(other, SlackRoomOccupant):
+        if not isinstance(other, _SlackOccupantMixin):
             log.warning(
-                "tried to compare a SlackRoomOccupant with a SlackPerson %s vs %s",
+                "tried to compare a %s with a %s %s vs %s",
+                type(self).__name__,
+                type(other).__name__,
                 self,
                 other,
             )
             return False
-        return other.room.id == self.room.id and other.userid == self.userid
+        return other._room.id == self._room.id and other._userid == self._userid
+
+    def __hash__(self):
+        return hash((self._room.id, self._userid))
+
+
+class SlackRoomOccupant(_SlackOccupantMixin, RoomOccupant, SlackPerson):
+    """
+    This class represents a person inside a MUC.
+    """
+
+    def __init__(self, webclient: WebClient, userid, channelid, bot, room=None):
+        super().__init__(webclient, userid, channelid)
+        self._room = (
+            room if room is not None else _shared_room(webclient, channelid, bot)
+        )
 
 
 class SlackBot(SlackPerson):
@@ -340,31 +498,11 @@ class SlackBot(SlackPerson):
         return None
 
 
-class SlackRoomBot(RoomOccupant, SlackBot):
+class SlackRoomBot(_SlackOccupantMixin, RoomOccupant, SlackBot):
     """
     This class represents a bot inside a MUC.
     """
 
     def __init__(self, webclient, bot_id, bot_username, channelid, bot):
         super().__init__(webclient, bot_id, bot_username)
-        self._room = SlackRoom(webclient=webclient, channelid=channelid, bot=bot)
-
-    @property
-    def room(self):
-        return self._room
-
-    def __unicode__(self):
-        return f"#{self._room.name}/{self.username}"
-
-    def __str__(self):
-        return self.__unicode__()
-
-    def __eq__(self, other):
-        if not isinstance(other, SlackRoomOccupant):
-            log.warning(
-                "tried to compare a SlackRoomBotOccupant with a SlackPerson %s vs %s",
-                self,
-                other,
-            )
-            return False
-        return other.room.id == self.room.id and other.userid == self.userid
+        self._room = _shared_room(webclient, channelid, bot)
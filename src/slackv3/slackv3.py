@@ -1,10 +1,15 @@
+import contextlib
 import copyreg
-import json
+import io
 import logging
 import pprint
-import re
+import shutil
 import sys
+import tempfile
 import threading
+import urllib.request
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from functools import lru_cache
 from typing import BinaryIO
 
@@ -28,17 +33,37 @@ from errbot.core_plugins import flask_app
 from errbot.utils import split_string_after
 
 from slackv3.lib import (
+    CHANNEL_ID_PREFIXES,
     COLORS,
+    SLACK_BARE_URI,
     SLACK_CLIENT_CHANNEL_HYPERLINK,
+    SLACK_LABELLED_URI,
+    SLACK_MENTION,
+    USER_ID_PREFIXES,
     SlackAPIResponseError,
+    TTLCache,
+    paginate,
+    ttl_from_env,
 )
 from slackv3.markdown import slack_markdown_converter
-from slackv3.person import SlackPerson
-from slackv3.room import SlackBot, SlackRoom, SlackRoomBot, SlackRoomOccupant
+from slackv3.person import SlackPerson, forget_user, users_index
+from slackv3.room import (
+    CHANNEL_ID_CACHE,
+    SlackBot,
+    SlackRoom,
+    SlackRoomBot,
+    SlackRoomOccupant,
+    forget_channel,
+)
 
 log = logging.getLogger(__name__)
 
 try:
+    from slack_sdk.errors import SlackApiError
+    from slack_sdk.http_retry.builtin_handlers import (
+        ConnectionErrorRetryHandler,
+        RateLimitErrorRetryHandler,
+    )
     from slack_sdk.rtm.v2 import RTMClient
     from slack_sdk.socket_mode import SocketModeClient
     from slack_sdk.socket_mode.request import SocketModeRequest
@@ -54,6 +79,131 @@ except ImportError:
     sys.exit(1)
 
 
+# Uploads run on their own workers so they can't starve errbot's command pool.
+# Callers requesting more than MAX_PENDING_UPLOADS at once wait for a free slot.
+UPLOAD_WORKERS = 4
+MAX_PENDING_UPLOADS = 64
+# Slack needs an upload's length up front, so non-seekable streams are copied
+# first.  Up to this many bytes are kept in memory, larger streams go to disk.
+UPLOAD_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# OAuth scopes of legacy and classic bots, which can only use the RTM API.
+LEGACY_BOT_SCOPES = frozenset(
+    [
+        "apps",
+        "bot",
+        "bot:basic",
+        "client",
+        "files:write:user",
+        "identify",
+        "post",
+        "read",
+    ]
+)
+
+# Longer message bodies are converted without keeping them in the markdown cache.
+MARKDOWN_CACHE_MAX_LENGTH = 16384
+
+# Message subtypes that never reach the bot's message callbacks.
+IGNORED_MESSAGE_SUBTYPES = frozenset(
+    ["message_deleted", "channel_topic", "message_replied"]
+)
+
+# List of events obtained from https://api.slack.com/events
+SLACK_EVENT_TYPES = frozenset(
+    [
+        "app_home_opened",
+        "app_mention",
+        "app_rate_limited",
+        "app_requested",
+        "app_uninstalled",
+        "call_rejected",
+        "channel_archive",
+        "channel_created",
+        "channel_deleted",
+        "channel_history_changed",
+        "channel_left",
+        "channel_rename",
+        "channel_shared",
+        "channel_unarchive",
+        "channel_unshared",
+        "dnd_updated",
+        "dnd_updated_user",
+        "email_domain_changed",
+        "emoji_changed",
+        "file_change",
+        "file_comment_added",
+        "file_comment_deleted",
+        "file_comment_edited",
+        "file_created",
+        "file_deleted",
+        "file_public",
+        "file_shared",
+        "file_unshared",
+        "grid_migration_finished",
+        "grid_migration_started",
+        "group_archive",
+        "group_close",
+        "group_deleted",
+        "group_history_changed",
+        "group_left",
+        "group_open",
+        "group_rename",
+        "group_unarchive",
+        "im_close",
+        "im_created",
+        "im_history_changed",
+        "im_open",
+        "hello",
+        "invite_requested",
+        "link_shared",
+        "member_joined_channel",
+        "member_left_channel",
+        "message",
+        "message.app_home",
+        "message.channels",
+        "message.groups",
+        "message.im",
+        "message.mpim",
+        "pin_added",
+        "pin_removed",
+        "reaction_added",
+        "reaction_removed",
+        "resources_added",
+        "resources_removed",
+        "scope_denied",
+        "scope_granted",
+        "star_added",
+        "star_removed",
+        "subteam_created",
+        "subteam_members_changed",
+        "subteam_self_added",
+        "subteam_self_removed",
+        "subteam_updated",
+        "team_domain_change",
+        "team_join",
+        "team_rename",
+        "tokens_revoked",
+        "url_verification",
+        "user_change",
+        "user_resource_denied",
+        "user_resource_granted",
+        "user_resource_removed",
+        "workflow_step_execute",
+    ]
+)
+
+
+def _stream_length(stream):
+    """
+    Size in bytes of what is left to read in a seekable stream.
+    """
+    position = stream.tell()
+    length = stream.seek(0, io.SEEK_END) - position
+    stream.seek(position)
+    return length
+
+
 class SlackBackend(ErrBot):
     def __init__(self, config):
         super().__init__(config)
@@ -79,11 +229,55 @@ class SlackBackend(ErrBot):
         self.slack_events = None
         self.slack_socket_mode = None
         self.bot_identifier = None
+        # Set once shutdown completes to release serve_once() from waiting for events.
+        self._shutdown_event = threading.Event()
+        self._shutdown_lock = threading.Lock()
+        # Bot identity and settings the alternate prefixes were last converted for.
+        self._alt_prefixes_key = None
+        # SlackRoom instances by channel id, alive for as long as something uses them.
+        self._rooms = weakref.WeakValueDictionary()
+        # SlackRoomBot instances by (bot id, username, channel id), reused the same way.
+        self._room_bots = weakref.WeakValueDictionary()
+        self._im_channel_cache = TTLCache(
+            ttl=ttl_from_env("SLACKV3_IM_CHANNEL_TTL", 3600)
+        )
+        self._send_executor = ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="slackv3-send"
+        )
+        self._upload_executor = ThreadPoolExecutor(
+            max_workers=UPLOAD_WORKERS, thread_name_prefix="slackv3-upload"
+        )
+        self._upload_slots = threading.BoundedSemaphore(MAX_PENDING_UPLOADS)
+
+        # Event type -> bound handler method, for the Events API and the RTM API.
+        self._event_handlers = self._build_event_handlers("_handle_")
+        self._rtm_event_handlers = self._build_event_handlers("_rtm_handle_")
 
         compact = config.COMPACT_OUTPUT if hasattr(config, "COMPACT_OUTPUT") else False
+        # Cards splitting into more parts than this are sent as a single snippet.
+        self.card_snippet_parts = getattr(config, "SLACK_CARD_SNIPPET_PARTS", None)
         self.md = slack_markdown_converter(compact)
+        # Markdown instances keep per-conversion state and aren't thread-safe.
+        self._md_lock = threading.Lock()
+        # Bots often repeat the same replies (help, errors), keep recent conversions.
+        self._md_convert = lru_cache(maxsize=256)(self._convert_markdown)
         self._register_identifiers_pickling()
 
+    def _build_event_handlers(self, prefix):
+        """
+        Map Slack event types to the handler methods named `<prefix><event type>`.
+        """
+        return {
+            name[len(prefix) :]: getattr(self, name)
+            for name in dir(type(self))
+            if name.startswith(prefix)
+        }
+
+    def _convert_markdown(self, text):
+        """Convert markdown to Slack's format with the backend's shared converter."""
+        with self._md_lock:
+            return self.md.convert(text)
+
     def set_message_size_limit(self, limit=4096, hard_limit=40000):
         """
         Slack supports upto 40000 characters per message, Errbot maintains 4096 by default.
@@ -156,6 +350,15 @@ class SlackBackend(ErrBot):
         except AttributeError:
             bot_prefixes = list(self.bot_config.BOT_ALT_PREFIXES)
 
+        # Reconnections keep the same prefixes, don't look them up again.
+        key = (
+            self.auth.get("user_id"),
+            tuple(bot_prefixes),
+            self.bot_config.BOT_ALT_PREFIX_CASEINSENSITIVE,
+        )
+        if key == self._alt_prefixes_key:
+            return
+
         converted_prefixes = []
         for prefix in bot_prefixes:
             try:
@@ -164,111 +367,56 @@ class SlackBackend(ErrBot):
                 log.error(
                     f'Failed to look up Slack userid for alternate prefix "{prefix}": {str(e)}'
                 )
+        # Retry failed lookups on the next connection.
+        if len(converted_prefixes) == len(bot_prefixes):
+            self._alt_prefixes_key = key
 
-        self.bot_alt_prefixes = tuple(
-            x.lower() for x in self.bot_config.BOT_ALT_PREFIXES
-        )
-        log.debug(f"Converted bot_alt_prefixes: {self.bot_config.BOT_ALT_PREFIXES}")
+        # Keep the plain text prefixes as well, e.g. "errbot help" next to "@errbot help".
+        prefixes = tuple(converted_prefixes) + tuple(bot_prefixes)
+        if self.bot_config.BOT_ALT_PREFIX_CASEINSENSITIVE:
+            prefixes = tuple(x.lower() for x in prefixes)
+        self.bot_alt_prefixes = prefixes
+        log.debug("Converted bot_alt_prefixes: %s", self.bot_alt_prefixes)
 
     def _setup_event_callbacks(self):
-        # List of events obtained from https://api.slack.com/events
-        slack_event_types = [
-            "app_home_opened",
-            "app_mention",
-            "app_rate_limited",
-            "app_requested",
-            "app_uninstalled",
-            "call_rejected",
-            "channel_archive",
-            "channel_created",
-            "channel_deleted",
-            "channel_history_changed",
-            "channel_left",
-            "channel_rename",
-            "channel_shared",
-            "channel_unarchive",
-            "channel_unshared",
-            "dnd_updated",
-            "dnd_updated_user",
-            "email_domain_changed",
-            "emoji_changed",
-            "file_change",
-            "file_comment_added",
-            "file_comment_deleted",
-            "file_comment_edited",
-            "file_created",
-            "file_deleted",
-            "file_public",
-            "file_shared",
-            "file_unshared",
-            "grid_migration_finished",
-            "grid_migration_started",
-            "group_archive",
-            "group_close",
-            "group_deleted",
-            "group_history_changed",
-            "group_left",
-            "group_open",
-            "group_rename",
-            "group_unarchive",
-            "im_close",
-            "im_created",
-            "im_history_changed",
-            "im_open",
-            "hello",
-            "invite_requested",
-            "link_shared",
-            "member_joined_channel",
-            "member_left_channel",
-            "message",
-            "message.app_home",
-            "message.channels",
-            "message.groups",
-            "message.im",
-            "message.mpim",
-            "pin_added",
-            "pin_removed",
-            "reaction_added",
-            "reaction_removed",
-            "resources_added",
-            "resources_removed",
-            "scope_denied",
-            "scope_granted",
-            "star_added",
-            "star_removed",
-            "subteam_created",
-            "subteam_members_changed",
-            "subteam_self_added",
-            "subteam_self_removed",
-            "subteam_updated",
-            "team_domain_change",
-            "team_join",
-            "team_rename",
-            "tokens_revoked",
-            "url_verification",
-            "user_change",
-            "user_resource_denied",
-            "user_resource_granted",
-            "user_resource_removed",
-            "workflow_step_execute",
-        ]
-        for t in slack_event_types:
+        # Only subscribe to the events a handler exists for, anything else would be
+        # dropped by _generic_wrapper anyway.
+        for t in sorted(SLACK_EVENT_TYPES & self._event_handlers.keys()):
             # slacksdk checks for duplicates only when passing a list of callbacks
             self.slack_events.on(t, self._generic_wrapper)
 
         self.connect_callback()
 
-    def serve_once(self):
-        self.slack_web = WebClient(token=self.token, proxy=self.proxies)
+    def _create_web_client(self):
+        """
+        Create the Web API client shared by the backend, the RTM/socket-mode clients
+        and every Slack identifier built from them.
+        """
+        return WebClient(
+            token=self.token,
+            proxy=self.proxies,
+            retry_handlers=[
+                ConnectionErrorRetryHandler(),
+                RateLimitErrorRetryHandler(),
+            ],
+        )
 
-        log.info("Verifying authentication token")
-        self.auth = self.slack_web.auth_test()
-        log.debug(f"Auth response: {self.auth}")
-        if not self.auth["ok"]:
-            raise SlackAPIResponseError(
-                error=f"Failed to authenticate with Slack.  Slack Error: {self.auth['error']}"
-            )
-        log.info("Token accepted")
+    def serve_once(self):
+        # Reuse the same client across reconnects.
+        if self.slack_web is None:
+            self.slack_web = self._create_web_client()
+
+        # The token was verified by an earlier connection, reconnects reuse the result.
+        if self.auth is None:
+            log.info("Verifying authentication token")
+            auth = self.slack_web.auth_test()
+            log.debug("Auth response: %s", auth)
+            if not auth["ok"]:
+                raise SlackAPIResponseError(
+                    error=f"Failed to authenticate with Slack.  Slack Error: {auth['error']}"
+                )
+            log.info("Token accepted")
+            self.auth = auth
         self.bot_identifier = SlackPerson(self.slack_web, self.auth["user_id"])
         log.debug(self.bot_identifier)
 
@@ -276,21 +424,11 @@ class SlackBackend(ErrBot):
         self.update_alternate_prefixes()
 
         # detect legacy and classic bot based on auth_test response (https://api.slack.com/scopes)
-        if set(
-            [
-                "apps",
-                "bot",
-                "bot:basic",
-                "client",
-                "files:write:user",
-                "identify",
-                "post",
-                "read",
-            ]
-        ).issuperset(self.auth.headers["x-oauth-scopes"].split(",")):
+        if LEGACY_BOT_SCOPES.issuperset(self.auth.headers["x-oauth-scopes"].split(",")):
             log.info("Using RTM API.")
             self.slack_rtm = RTMClient(
                 token=self.token,
+                web_client=self.slack_web,
                 proxy=self.proxies,
                 auto_reconnect_enabled=True,
             )
@@ -298,13 +436,13 @@ class SlackBackend(ErrBot):
             @self.slack_rtm.on("*")
             def _rtm_generic_event_handler(client: RTMClient, event: dict):
                 """Calls the rtm event handler based on the event type"""
-                log.debug("Received rtm event: {}".format(str(event)))
+                log.debug("Received rtm event: %s", event)
                 event_type = event["type"]
-                try:
-                    event_handler = getattr(self, f"_rtm_handle_{event_type}")
-                    return event_handler(client, event)
-                except AttributeError:
-                    log.debug(f"RTM event type {event_type} not supported.")
+                event_handler = self._rtm_event_handlers.get(event_type)
+                if event_handler is None:
+                    log.debug("RTM event type %s not supported.", event_type)
+                    return
+                return event_handler(client, event)
 
             log.info("Connecting to Slack RTM API")
             self.slack_rtm.connect()
@@ -339,8 +477,9 @@ class SlackBackend(ErrBot):
 
         try:
             log.debug("Initialised, waiting for events.")
-            # Block here to remain in serve_once().
-            threading.Event().wait()
+            # Block here to remain in serve_once() until shutdown is requested.
+            self._shutdown_event.wait()
+            return True
         except KeyboardInterrupt:
             log.info("Interrupt received, shutting down..")
             return True
@@ -352,16 +491,16 @@ class SlackBackend(ErrBot):
 
     def _generic_wrapper(self, event_data):
         """Calls the event handler based on the event type"""
-        log.debug("Received event: {}".format(str(event_data)))
+        log.debug("Received event: %s", event_data)
         try:
             event = event_data["event"]
             event_type = event["type"]
 
-            try:
-                event_handler = getattr(self, f"_handle_{event_type}")
-                return event_handler(self.slack_web, event)
-            except AttributeError:
-                log.debug(f"Event type {event_type} not supported.")
+            event_handler = self._event_handlers.get(event_type)
+            if event_handler is None:
+                log.debug("Event type %s not supported.", event_type)
+                return
+            return event_handler(self.slack_web, event)
         except KeyError:
             log.debug("Ignoring unsupported Slack event!")
 
@@ -369,11 +508,16 @@ class SlackBackend(ErrBot):
         self, client: SocketModeClient, req: SocketModeRequest
     ):
         log.debug(
-            f"Event type: {req.type}\n"
-            f"Envelope ID: {req.envelope_id}\n"
-            f"Accept Response Payload: {req.accepts_response_payload}\n"
-            f"Retry Attempt: {req.retry_attempt}\n"
-            f"Retry Reason: {req.retry_reason}\n"
+            "Event type: %s\n"
+            "Envelope ID: %s\n"
+            "Accept Response Payload: %s\n"
+            "Retry Attempt: %s\n"
+            "Retry Reason: %s\n",
+            req.type,
+            req.envelope_id,
+            req.accepts_response_payload,
+            req.retry_attempt,
+            req.retry_reason,
         )
         # Acknowledge the request
         client.send_socket_mode_response(
@@ -386,7 +530,7 @@ class SlackBackend(ErrBot):
         # Workaround socket-mode client calling handler twice with different signatures.
         if len(args) == 3:
             sm_client, event, raw_event = args
-            log.debug(f"message listeners : {sm_client.message_listeners}")
+            log.debug("message listeners : %s", sm_client.message_listeners)
             if event["type"] == "hello":
                 self.connect_callback()
                 self.callback_presence(
@@ -398,7 +542,6 @@ class SlackBackend(ErrBot):
 
     def _rtm_handle_hello(self, client: RTMClient, event: dict):
         """Event handler for the 'hello' event"""
-        self.slack_web = client.web_client
         self.connect_callback()
         self.callback_presence(Presence(identifier=self.bot_identifier, status=ONLINE))
 
@@ -451,7 +594,7 @@ class SlackBackend(ErrBot):
 
     def _handle_reaction_event(self, event, action):
         """Event handler for the 'reaction_added' and 'reaction_removed' events"""
-        log.debug("Reaction: {} {}".format(event["type"], event["reaction"]))
+        log.debug("Reaction: %s %s", event["type"], event["reaction"])
         user = SlackPerson(self.slack_web, event["user"])
 
         item_user = event.get("item_user")
@@ -472,14 +615,14 @@ class SlackBackend(ErrBot):
     def _handle_message(self, webclient: WebClient, event):
         """Event handler for the 'message' event"""
         channel = event["channel"]
-        if channel[0] not in "CGD":
+        if channel[:1] not in CHANNEL_ID_PREFIXES:
             log.warning(f"Unknown message type! Unable to handle {channel}")
             return
 
         subtype = event.get("subtype", None)
 
-        if subtype in ("message_deleted", "channel_topic", "message_replied"):
-            log.debug(f"Message of type {subtype}, ignoring this event")
+        if subtype in IGNORED_MESSAGE_SUBTYPES:
+            log.debug("Message of type %s, ignoring this event", subtype)
             return
 
         if subtype == "message_changed" and "attachments" in event["message"]:
@@ -504,11 +647,17 @@ class SlackBackend(ErrBot):
             text = event.get("text", "")
             user = event.get("user", event.get("bot_id"))
 
+        # Errbot ignores its own messages, skip them before any text processing.
+        if user == self.bot_identifier.userid:
+            log.debug("Ignoring message from self.")
+            return
+
         text, mentioned = self.process_mentions(text)
         text = self.sanitize_uris(text)
 
-        log.debug(f"Saw an event: {pprint.pformat(event)}")
-        log.debug(f"Escaped IDs event text: {text}")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Saw an event: %s", pprint.pformat(event))
+        log.debug("Escaped IDs event text: %s", text)
 
         msg = Message(
             text,
@@ -527,33 +676,20 @@ class SlackBackend(ErrBot):
                 )
                 msg.to = SlackPerson(webclient, user, channel)
             else:
-                if user == self.bot_identifier.userid:
-                    msg.frm = self.bot_identifier
-                    msg.to = self.bot_identifier
-                else:
-                    msg.frm = SlackPerson(webclient, user, channel)
-                    msg.to = msg.frm
+                msg.frm = SlackPerson(webclient, user, channel)
+                msg.to = msg.frm
             msg.extras["url"] = (
                 f"https://{msg.frm.domain}.slack.com/archives/"
                 f'{event["channel"]}/p{self._ts_for_message(msg).replace(".", "")}'
             )
         else:
             if subtype == "bot_message":
-                msg.frm = SlackRoomBot(
-                    webclient,
-                    bot_id=event.get("bot_id"),
-                    bot_username=event.get("username", ""),
-                    channelid=channel,
-                    bot=self,
+                msg.frm = self._get_room_bot(
+                    webclient, event.get("bot_id"), event.get("username", ""), channel
                 )
-                msg.to = SlackRoom(webclient=webclient, channelid=channel, bot=self)
             else:
-                if user == self.bot_identifier.userid:
-                    msg.frm = self.bot_identifier
-                    msg.to = self.bot_identifier
-                else:
-                    msg.to = SlackRoom(webclient=webclient, channelid=channel, bot=self)
-                    msg.frm = SlackRoomOccupant(webclient, user, channel, self)
+                msg.frm = SlackRoomOccupant(webclient, user, channel, self)
+            msg.to = msg.frm.room
 
         self.callback_message(msg)
 
@@ -567,9 +703,52 @@ class SlackBackend(ErrBot):
         """Event handler for the 'member_joined_channel' event"""
         user = SlackPerson(webclient, event["user"])
         if user == self.bot_identifier:
-            self.callback_room_joined(
-                SlackRoom(webclient=webclient, channelid=event["channel"], bot=self)
-            )
+            self.callback_room_joined(self.get_room(event["channel"]))
+
+    def _rtm_handle_channel_rename(self, client: RTMClient, event: dict):
+        self._handle_channel_rename(client.web_client, event)
+
+    _rtm_handle_group_rename = _rtm_handle_channel_rename
+
+    def _handle_channel_rename(self, webclient: WebClient, event):
+        """Event handler for the 'channel_rename' and 'group_rename' events"""
+        channel = event["channel"]
+        forget_channel(channel["id"], channel["name"])
+
+    _handle_group_rename = _handle_channel_rename
+
+    def _rtm_handle_channel_archive(self, client: RTMClient, event: dict):
+        self._handle_channel_archive(client.web_client, event)
+
+    _rtm_handle_channel_unarchive = _rtm_handle_channel_archive
+    _rtm_handle_channel_deleted = _rtm_handle_channel_archive
+    _rtm_handle_group_archive = _rtm_handle_channel_archive
+    _rtm_handle_group_unarchive = _rtm_handle_channel_archive
+    _rtm_handle_group_deleted = _rtm_handle_channel_archive
+
+    def _handle_channel_archive(self, webclient: WebClient, event):
+        """Event handler for the channel and group archive/unarchive/deleted events"""
+        forget_channel(event["channel"])
+
+    _handle_channel_unarchive = _handle_channel_archive
+    _handle_channel_deleted = _handle_channel_archive
+    _handle_group_archive = _handle_channel_archive
+    _handle_group_unarchive = _handle_channel_archive
+    _handle_group_deleted = _handle_channel_archive
+
+    def _rtm_handle_user_change(self, client: RTMClient, event: dict):
+        self._handle_user_change(client.web_client, event)
+
+    def _handle_user_change(self, webclient: WebClient, event):
+        """Event handler for the 'user_change' event"""
+        forget_user(event["user"])
+
+    def _rtm_handle_team_join(self, client: RTMClient, event: dict):
+        self._handle_team_join(client.web_client, event)
+
+    def _handle_team_join(self, webclient: WebClient, event):
+        """Event handler for the 'team_join' event"""
+        forget_user(event["user"], joined=True)
 
     def userid_to_username(self, id_: str):
         """Convert a Slack user ID to their user name"""
@@ -588,17 +767,7 @@ class SlackBackend(ErrBot):
         username = name.lstrip("@")
         if username == self.auth["user"]:
             return self.bot_identifier.userid
-        user_ids = []
-        cursor = None
-        while cursor != "":
-            res = self.slack_web.users_list(cursor=cursor, limit=1000)
-            if res["ok"] is False:
-                log.exception(f"Unable to list users.  Slack error: {res['error']}")
-            for user in res["members"]:
-                if user["name"] == username:
-                    user_ids.append(user["id"])
-            else:
-                cursor = res["response_metadata"].get("next_cursor", "")
+        user_ids = users_index(self.slack_web).get(username, ())
         if len(user_ids) == 0:
             raise UserDoesNotExistError(f"Cannot find user '{username}'.")
         if len(user_ids) > 1:
@@ -607,17 +776,17 @@ class SlackBackend(ErrBot):
             )
         return user_ids[0]
 
-    @lru_cache(1024)
     def channelid_to_channelname(self, id_: str):
-        """Convert a Slack channel ID to its channel name"""
-        log.debug(f"get channel name from {id_}")
-        room = SlackRoom(self.slack_web, channelid=id_, bot=self)
-        return room.channelname
+        """
+        Convert a Slack channel ID to its channel name.  The name is read from the
+        channel details ROOM_INFO_CACHE shares across the backend.
+        """
+        log.debug("get channel name from %s", id_)
+        return self.get_room(id_).channelname
 
-    @lru_cache(1024)
     def channelname_to_channelid(self, name: str):
         """Convert a Slack channel name to its channel ID"""
-        log.debug(f"get channel id from {name}")
+        log.debug("get channel id from %s", name)
         return SlackRoom(self.slack_web, name=name, bot=self).id
 
     def channels(
@@ -640,30 +809,72 @@ class SlackBackend(ErrBot):
             References:
                 - https://slack.com/api/conversations.list
         """
-        response = self.slack_web.conversations_list(
-            exclude_archived=exclude_archived, types=types
-        )
-
-        channels = [
-            channel
-            for channel in response["channels"]
-            if channel["is_member"] or not joined_only
-        ]
+        channels = []
+        for response in paginate(
+            self.slack_web.conversations_list,
+            exclude_archived=exclude_archived,
+            types=types,
+            limit=1000,
+            prefetch=True,
+        ):
+            if not response["ok"]:
+                raise SlackAPIResponseError(
+                    f"Unable to list channels.  Slack error: {response['error']}",
+                    error=response["error"],
+                )
+            for channel in response["channels"]:
+                # Rooms are often built by name right after listing channels.
+                CHANNEL_ID_CACHE.set(channel["name"], channel["id"])
+                if channel["is_member"] or not joined_only:
+                    channels.append(channel)
 
         return channels
 
-    @lru_cache(1024)
     def get_im_channel(self, id_):
         """Open a direct message channel to a user"""
+        # Bots are cached as an empty string so they aren't probed again.
+        return (
+            self._im_channel_cache.get(id_, lambda: self._open_im_channel(id_)) or None
+        )
+
+    def _open_im_channel(self, id_):
         try:
             response = self.slack_web.conversations_open(users=id_)
             return response["channel"]["id"]
-        except SlackAPIResponseError as e:
-            if e.error == "cannot_dm_bot":
+        except SlackApiError as e:
+            if e.response["error"] == "cannot_dm_bot":
                 log.info("Tried to DM a bot.")
-                return None
-            else:
-                raise e
+                return ""
+            raise
+
+    def get_room(self, channelid):
+        """
+        Return the SlackRoom for a channel id, reusing the instance already handed
+        out for it when there is one.
+        """
+        room = self._rooms.get(channelid)
+        if room is None:
+            room = SlackRoom(webclient=self.slack_web, channelid=channelid, bot=self)
+            self._rooms[channelid] = room
+        return room
+
+    def _get_room_bot(self, webclient, bot_id, bot_username, channelid):
+        """
+        Return the SlackRoomBot posting as bot_username in a channel, reusing the
+        instance already handed out for it when there is one.
+        """
+        key = (bot_id, bot_username, channelid)
+        room_bot = self._room_bots.get(key)
+        if room_bot is None:
+            room_bot = SlackRoomBot(
+                webclient,
+                bot_id=bot_id,
+                bot_username=bot_username,
+                channelid=channelid,
+                bot=self,
+            )
+            self._room_bots[key] = room_bot
+        return room_bot
 
     def _prepare_message(self, msg):  # or card
         """
@@ -680,12 +891,15 @@ class SlackBackend(ErrBot):
             )
         else:
             to_humanreadable = msg.to.username
-            to_channel_id = msg.to.channelid
-            if to_channel_id.startswith("C"):
+            if isinstance(
+                msg.to, RoomOccupant
+            ):  # private to a room occupant -> this is a divert to private !
                 log.debug(
                     "This is a divert to private message, sending it directly to the user."
                 )
                 to_channel_id = self.get_im_channel(msg.to.userid)
+            else:
+                to_channel_id = msg.to.channelid
         return to_humanreadable, to_channel_id
 
     def send_message(self, msg) -> Message:
@@ -704,36 +918,24 @@ class SlackBackend(ErrBot):
 
         to_humanreadable = "<unknown>"
         try:
-            if msg.is_group:
-                to_channel_id = msg.to.id
-                to_humanreadable = (
-                    msg.to.name
-                    if msg.to.name
-                    else self.channelid_to_channelname(to_channel_id)
-                )
-            else:
-                to_humanreadable = msg.to.username
-                if isinstance(
-                    msg.to, RoomOccupant
-                ):  # private to a room occupant -> this is a divert to private !
-                    log.debug(
-                        "This is a divert to private message, sending it directly to the user."
-                    )
-                    to_channel_id = self.get_im_channel(msg.to.userid)
-                else:
-                    to_channel_id = msg.to.channelid
-
+            to_humanreadable, to_channel_id = self._prepare_message(msg)
             msgtype = "direct" if msg.is_direct else "channel"
             log.debug(
-                f"Sending {msgtype} message to {to_humanreadable} ({to_channel_id})."
+                "Sending %s message to %s (%s).",
+                msgtype,
+                to_humanreadable,
+                to_channel_id,
             )
-            body = self.md.convert(msg.body)
-            log.debug(f"Message size: {len(body)}.")
+            if len(msg.body) <= MARKDOWN_CACHE_MAX_LENGTH:
+                body = self._md_convert(msg.body)
+            else:
+                body = self._convert_markdown(msg.body)
+            log.debug("Message size: %s.", len(body))
 
             parts = self.prepare_message_body(body, self.message_size_limit)
             current_ts_length = len(msg.extras.get("ts", ""))
 
-            timestamps = []
+            results = []
             for index, part in enumerate(parts):
                 data = {
                     "channel": to_channel_id,
@@ -747,11 +949,11 @@ class SlackBackend(ErrBot):
                     # Only add attachments/blocks if it's the last message, to avoid duplication
                     if "attachments" in msg.extras:
                         # If attachments are provided, and it's the last part of the mssage
-                        data["attachments"] = json.dumps(msg.extras["attachments"])
+                        data["attachments"] = msg.extras["attachments"]
 
                     if "blocks" in msg.extras:
                         # If blocksare provided, and it's the last part of the mssage
-                        data["blocks"] = json.dumps(msg.extras["blocks"])
+                        data["blocks"] = msg.extras["blocks"]
 
                 # Keep the thread_ts to answer to the same thread.
                 if "thread_ts" in msg.extras:
@@ -759,8 +961,11 @@ class SlackBackend(ErrBot):
 
                 if "ts" in msg.extras and current_ts_length > index:
                     # If a timestamp exists for the current chunk, update it - otherwise, send it as new
+                    # Edits of existing parts can't reorder the thread, run them concurrently.
                     data["ts"] = msg.extras["ts"][index]
-                    result = self.slack_web.chat_update(**data)
+                    result = self._send_executor.submit(
+                        self.slack_web.chat_update, **data
+                    )
 
                 elif msg.extras.get("ephemeral"):
                     data["user"] = msg.to.userid
@@ -770,13 +975,19 @@ class SlackBackend(ErrBot):
                     result = self.slack_web.chat_postEphemeral(**data)
                 else:
                     result = self.slack_web.chat_postMessage(**data)
+                results.append(result)
 
+            timestamps = []
+            for result in results:
+                if isinstance(result, Future):
+                    result = result.result()
                 if "ts" in result:
                     timestamps.append(result["ts"])
 
             if "ts" in msg.extras and current_ts_length > len(parts):
                 # If we have more timestamps than msg parts, delete the remaining timestamps
-                for timestamp in msg.extras["ts"][len(parts) - current_ts_length - 1]:
+                deletions = []
+                for timestamp in msg.extras["ts"][len(parts) :]:
                     data = {
                         "channel": to_channel_id,
                         "ts": timestamp,
@@ -784,7 +995,11 @@ class SlackBackend(ErrBot):
                         "link_names": "1",
                         "as_user": "true",
                     }
-                    self.slack_web.chat_delete(**data)
+                    deletions.append(
+                        self._send_executor.submit(self.slack_web.chat_delete, **data)
+                    )
+                for deletion in deletions:
+                    deletion.result()
 
             msg.extras["ts"] = timestamps
         except Exception:
@@ -808,11 +1023,32 @@ class SlackBackend(ErrBot):
         :param stream: Stream object
         :return: None
         """
+        if isinstance(stream.identifier, SlackRoom):
+            channel_id = stream.identifier.id
+        else:
+            channel_id = stream.identifier.channelid
         try:
-            stream.accept()
-            resp = self.slack_web.files_upload(
-                channels=stream.identifier.channelid, filename=stream.name, file=stream
-            )
+            with contextlib.ExitStack() as stack:
+                stream.accept()
+                # The size given with the stream request is only a hint, measure the
+                # content instead.  Streams that can't seek are spooled to measure them.
+                body = stream
+                if not stream.seekable():
+                    body = stack.enter_context(
+                        tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_SIZE)
+                    )
+                    shutil.copyfileobj(stream, body)
+                    body.seek(0)
+                length = _stream_length(body)
+                resp = self.slack_web.files_getUploadURLExternal(
+                    filename=stream.name, length=length
+                )
+                if resp.get("ok"):
+                    self._put_upload(resp["upload_url"], body, length)
+                    resp = self.slack_web.files_completeUploadExternal(
+                        files=[{"id": resp["file_id"], "title": stream.name}],
+                        channel_id=channel_id,
+                    )
             if resp.get("ok"):
                 stream.success()
             else:
@@ -822,6 +1058,33 @@ class SlackBackend(ErrBot):
                 f"Upload of {stream.name} to {stream.identifier.channelname} failed."
             )
 
+    def _put_upload(self, url: str, body: BinaryIO, length: int) -> None:
+        """
+        Send `length` bytes of a file object to a files.getUploadURLExternal upload url.
+        The file is read in blocks as it is sent rather than loaded in memory.
+        """
+        handlers = []
+        if self.proxies:
+            handlers.append(
+                urllib.request.ProxyHandler(
+                    {"http": self.proxies, "https": self.proxies}
+                )
+            )
+        request = urllib.request.Request(
+            url,
+            data=body,
+            headers={
+                "Content-Length": str(length),
+                "Content-Type": "application/octet-stream",
+            },
+            method="POST",
+        )
+        with urllib.request.build_opener(*handlers).open(request) as response:
+            if response.status != 200:
+                raise SlackAPIResponseError(
+                    f"Upload failed with HTTP status {response.status}."
+                )
+
     def send_stream_request(
         self,
         user: Identifier,
@@ -842,11 +1105,17 @@ class SlackBackend(ErrBot):
         :return Stream: object on which you can monitor the progress of it.
         """
         stream = Stream(user, fsource, name, size, stream_type)
-        log.debug(
-            f"Requesting upload of {name} to {user.channelname} "
-            f"(size hint: {size}, stream type: {stream_type})."
-        )
-        self.thread_pool.apply_async(self._slack_upload, (stream,))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                "Requesting upload of %s to %s (size hint: %s, stream type: %s).",
+                name,
+                user.channelname,
+                size,
+                stream_type,
+            )
+        self._upload_slots.acquire()
+        upload = self._upload_executor.submit(self._slack_upload, stream)
+        upload.add_done_callback(lambda _: self._upload_slots.release())
         return stream
 
     def send_card(self, card: Card):
@@ -866,9 +1135,7 @@ class SlackBackend(ErrBot):
             attachment["thumb_url"] = card.thumbnail
 
         if card.color:
-            attachment["color"] = (
-                COLORS[card.color] if card.color in COLORS else card.color
-            )
+            attachment["color"] = COLORS.get(card.color, card.color)
 
         if card.fields:
             attachment["fields"] = [
@@ -876,40 +1143,67 @@ class SlackBackend(ErrBot):
                 for key, value in card.fields
             ]
 
+        thread_ts = None
+        if card.parent is not None:
+            # we are asked to reply to a specific thread.
+            try:
+                thread_ts = self._ts_for_message(card.parent)
+            except KeyError:
+                # Cannot reply to thread without a timestamp from the parent.
+                log.exception(
+                    "The provided parent message is not a Slack message "
+                    "or does not contain a Slack timestamp."
+                )
+
+        data = {
+            "channel": to_channel_id,
+            "attachments": [attachment],
+            "link_names": "1",
+            "as_user": "true",
+        }
+        if thread_ts is not None:
+            data["thread_ts"] = thread_ts
+
         parts = self.prepare_message_body(card.body, self.message_size_limit)
         part_count = len(parts)
+        if self.card_snippet_parts and part_count > self.card_snippet_parts:
+            self._send_card_snippet(card, to_channel_id, thread_ts, to_humanreadable)
+            return
+
         footer = attachment.get("footer", "")
         for i in range(part_count):
+            # Parts are posted one at a time, only the attachment changes between them.
             if part_count > 1:
                 attachment["footer"] = f"{footer} [{i + 1}/{part_count}]"
             attachment["text"] = parts[i]
-            data = {
-                "channel": to_channel_id,
-                "attachments": json.dumps([attachment]),
-                "link_names": "1",
-                "as_user": "true",
-            }
-
-            if card.parent is not None:
-                # we are asked to reply to a specific thread.
-                try:
-                    data["thread_ts"] = self._ts_for_message(card.parent)
-                except KeyError:
-                    # Cannot reply to thread without a timestamp from the parent.
-                    log.exception(
-                        "The provided parent message is not a Slack message "
-                        "or does not contain a Slack timestamp."
-                    )
             try:
-                log.debug(f"Sending data:\n{data}")
+                log.debug("Sending data:\n%s", data)
                 self.slack_web.chat_postMessage(**data)
             except Exception:
                 log.exception(
                     f"An exception occurred while trying to send a card to {to_humanreadable}.[{card}]"
                 )
 
-    def __hash__(self):
-        return 0  # this is a singleton anyway
+    def _send_card_snippet(self, card, to_channel_id, thread_ts, to_humanreadable):
+        """
+        Send a long card body as one text snippet instead of many card parts.
+        """
+        try:
+            self.slack_web.files_upload_v2(
+                channel=to_channel_id,
+                content=card.body,
+                filename="message.md",
+                title=card.title or None,
+                initial_comment=card.summary or card.title or "",
+                thread_ts=thread_ts,
+            )
+        except Exception:
+            log.exception(
+                f"An exception occurred while trying to send a card to {to_humanreadable}.[{card}]"
+            )
+
+    # ErrBot's storage makes it a Mapping, which sets __hash__ to None.
+    __hash__ = object.__hash__
 
     def change_presence(self, status: str = ONLINE, message: str = "") -> None:
         self.slack_web.users_setPresence(
@@ -931,24 +1225,24 @@ class SlackBackend(ErrBot):
             [str]
 
         """
-        fixed_format = body.startswith("```")  # hack to fix the formatting
-        parts = list(split_string_after(body, size_limit))
-
-        if len(parts) == 1:
-            # If we've got an open fixed block, close it out
-            if parts[0].count("```") % 2 != 0:
-                parts[0] += "\n```\n"
-        else:
-            for i, part in enumerate(parts):
-                starts_with_code = part.startswith("```")
+        if len(body) <= size_limit:
+            # Most messages fit in a single part, only an unclosed block needs fixing.
+            if body.count("```") % 2 != 0:
+                body += "\n```\n"
+            return [body]
 
-                # If we're continuing a fixed block from the last part
-                if fixed_format and not starts_with_code:
-                    parts[i] = "```\n" + part
+        parts = list(split_string_after(body, size_limit))
 
-                # If we've got an open fixed block, close it out
-                if part.count("```") % 2 != 0:
-                    parts[i] += "\n```\n"
+        # Track whether a fixed block is open across parts in a single pass, so a
+        # block split over several parts is closed and reopened at each boundary.
+        in_fixed_block = False
+        for i, part in enumerate(parts):
+            if in_fixed_block:
+                parts[i] = "```\n" + parts[i]
+            if part.count("```") % 2 != 0:
+                in_fixed_block = not in_fixed_block
+            if in_fixed_block:
+                parts[i] += "\n```\n"
 
         return parts
 
@@ -997,25 +1291,22 @@ class SlackBackend(ErrBot):
             text = text[2:-1]
             if text == "":
                 raise ValueError(exception_message % "")
-            if text[0] in ("U", "B", "W"):
+            if text[0] in USER_ID_PREFIXES:
                 if "|" in text:
                     raise ValueError("Slack ID can not contain '|'.")
                 userid = text
-            elif text[0] in ("C", "G", "D"):
-                if "|" in text:
-                    channelid, channelname = text.split("|")
-                else:
-                    channelid = text
+            elif text[0] in CHANNEL_ID_PREFIXES:
+                channelid, separator, label = text.partition("|")
+                if separator:
+                    channelname = label
             else:
                 raise ValueError(exception_message % text)
         elif text[0] == "@":
             username = text[1:]
         elif text[0] == "#":
-            plainrep = text[1:]
-            if "/" in text:
-                channelname, username = plainrep.split("/", 1)
-            else:
-                channelname = plainrep
+            channelname, separator, user = text[1:].partition("/")
+            if separator:
+                username = user
         else:
             raise ValueError(exception_message % text)
 
@@ -1028,7 +1319,7 @@ class SlackBackend(ErrBot):
         Supports strings with the formats accepted by
         :func:`~extract_identifiers_from_string`.
         """
-        log.debug(f"Building an identifier from {txtrep}.")
+        log.debug("Building an identifier from %s.", txtrep)
         username, userid, channelname, channelid = self.extract_identifiers_from_string(
             txtrep
         )
@@ -1044,7 +1335,7 @@ class SlackBackend(ErrBot):
                 return self.bot_identifier
             return SlackPerson(self.slack_web, userid, self.get_im_channel(userid))
         if channelid is not None:
-            return SlackRoom(webclient=self.slack_web, channelid=channelid, bot=self)
+            return self.get_room(channelid)
 
         raise Exception(
             "You found a bug.  I expected at least one of userid, channelid, username "
@@ -1058,9 +1349,10 @@ class SlackBackend(ErrBot):
     def build_reply(self, msg, text=None, private=False, threaded=False):
         response = self.build_message(text)
 
-        if "thread_ts" in msg.extras["slack_event"]:
+        thread_ts = msg.extras["slack_event"].get("thread_ts")
+        if thread_ts is not None:
             # If we reply to a threaded message, keep it in the thread.
-            response.extras["thread_ts"] = msg.extras["slack_event"]["thread_ts"]
+            response.extras["thread_ts"] = thread_ts
         elif threaded:
             # otherwise check if we should start a new thread
             response.parent = msg
@@ -1079,7 +1371,7 @@ class SlackBackend(ErrBot):
         :param reaction: A str giving an emoji, without colons before and after.
         :raises: ValueError if the emoji doesn't exist.
         """
-        return self._react("reactions.add", msg, reaction)
+        return self._react(self.slack_web.reactions_add, msg, reaction)
 
     def remove_reaction(self, msg: Message, reaction: str) -> None:
         """
@@ -1088,9 +1380,9 @@ class SlackBackend(ErrBot):
         :param reaction: A str giving an emoji, without colons before and after.
         :raises: ValueError if the emoji doesn't exist.
         """
-        return self._react("reactions.remove", msg, reaction)
+        return self._react(self.slack_web.reactions_remove, msg, reaction)
 
-    def _react(self, method: str, msg: Message, reaction: str) -> None:
+    def _react(self, method, msg: Message, reaction: str) -> None:
         try:
             # this logic is from send_message
             if msg.is_group:
@@ -1100,37 +1392,38 @@ class SlackBackend(ErrBot):
 
             ts = self._ts_for_message(msg)
 
-            self.api_call(
-                method,
-                data={
-                    "json": {
-                        "channel": to_channel_id,
-                        "timestamp": ts,
-                        "name": reaction,
-                    }
-                },
-            )
-        except SlackAPIResponseError as e:
-            if e.error == "invalid_name":
-                raise ValueError(e.error, "No such emoji", reaction)
-            elif e.error in ("no_reaction", "already_reacted"):
+            method(channel=to_channel_id, timestamp=ts, name=reaction)
+        except SlackApiError as e:
+            error = e.response["error"]
+            if error == "invalid_name":
+                raise ValueError(error, "No such emoji", reaction)
+            elif error in ("no_reaction", "already_reacted"):
                 # This is common if a message was edited after you reacted to it, and you reacted
                 # to it again.  Chances are you don't care about this. If you do, call
                 # api_call() directly.
                 pass
             else:
-                raise SlackAPIResponseError(error=e.error)
+                raise SlackAPIResponseError(error=error)
 
     def _ts_for_message(self, msg):
-        try:
-            return msg.extras["slack_event"]["message"]["ts"]
-        except KeyError:
-            return msg.extras["slack_event"]["ts"]
+        event = msg.extras["slack_event"]
+        message = event.get("message")
+        if message is not None and "ts" in message:
+            return message["ts"]
+        return event["ts"]
 
     def shutdown(self):
-        if self.slack_rtm:
-            self.slack_rtm.close()
-        super().shutdown()
+        # serve_forever() calls shutdown() again once serve_once() is released.
+        with self._shutdown_lock:
+            if self._shutdown_event.is_set():
+                return
+            if self.slack_rtm:
+                self.slack_rtm.close()
+            # Plugins may still send messages while they are deactivated.
+            super().shutdown()
+            self._send_executor.shutdown(wait=False)
+            self._upload_executor.shutdown(wait=False)
+            self._shutdown_event.set()
 
     @property
     def mode(self):
@@ -1138,14 +1431,14 @@ class SlackBackend(ErrBot):
 
     def query_room(self, room):
         """Room can either be a name or a channelid"""
-        if room.startswith("C") or room.startswith("G"):
-            return SlackRoom(webclient=self.slack_web, channelid=room, bot=self)
+        if room.startswith(("C", "G")):
+            return self.get_room(room)
 
-        m = SLACK_CLIENT_CHANNEL_HYPERLINK.match(room)
-        if m is not None:
-            return SlackRoom(
-                webclient=self.slack_web, channelid=m.groupdict()["id"], bot=self
-            )
+        # Only channel links need the regex, plain names are the common case.
+        if room.startswith("<#"):
+            m = SLACK_CLIENT_CHANNEL_HYPERLINK.match(room)
+            if m is not None:
+                return self.get_room(m.group("id"))
 
         return SlackRoom(webclient=self.slack_web, name=room, bot=self)
 
@@ -1157,10 +1450,7 @@ class SlackBackend(ErrBot):
             A list of :class:`~SlackRoom` instances.
         """
         channels = self.channels(joined_only=True, exclude_archived=True)
-        return [
-            SlackRoom(webclient=self.slack_web, channelid=channel["id"], bot=self)
-            for channel in channels
-        ]
+        return [self.get_room(channel["id"]) for channel in channels]
 
     def prefix_groupchat_reply(self, message, identifier):
         super().prefix_groupchat_reply(message, identifier)
@@ -1178,11 +1468,35 @@ class SlackBackend(ErrBot):
         :returns:
             string
         """
-        text = re.sub(r"<([^#][^|>]+)\|([^|>]+)>", r"\2", text)
-        text = re.sub(r"<(http([^>]+))>", r"\1", text)
+        # Most messages contain no Slack formatted URI at all.
+        if "<" not in text:
+            return text
+        text = SLACK_LABELLED_URI.sub(r"\2", text)
+        text = SLACK_BARE_URI.sub(r"\1", text)
 
         return text
 
+    def _prefetch_im_channels(self, text):
+        """
+        Open the IM channels of every user mentioned in text concurrently, so
+        building their identifiers afterwards doesn't wait on one call per user.
+        """
+        user_ids = {
+            word[2:].rstrip(">")
+            for word in SLACK_MENTION.findall(text)
+            if word.startswith("<@") and "|" not in word
+        }
+        user_ids.discard(self.bot_identifier.userid)
+        if len(user_ids) < 2:
+            return
+        # Failed lookups are left for build_identifier to retry and report.
+        wait(
+            [
+                self._send_executor.submit(self.get_im_channel, user_id)
+                for user_id in user_ids
+            ]
+        )
+
     def process_mentions(self, text):
         """
         Process mentions in a given string
@@ -1191,28 +1505,34 @@ class SlackBackend(ErrBot):
             and a list of any :class:`~SlackPerson` or
             :class:`~SlackRoom` instances.
         """
+        # Most messages mention nobody, skip the regex pass entirely.
+        if "<" not in text:
+            return text, []
         mentioned = []
+        if text.count("<@") > 1:
+            self._prefetch_im_channels(text)
 
-        m = re.findall("<[@#][^>]*>*", text)
-
-        for word in m:
+        def replace(match):
+            word = match.group(0)
             try:
                 identifier = self.build_identifier(word)
             except Exception as e:
                 log.debug(
-                    f"Tried to build an identifier from '{word}' "
-                    f"but got exception: {e}"
+                    "Tried to build an identifier from '%s' but got exception: %s",
+                    word,
+                    e,
                 )
-                continue
+                return word
 
             # We track mentions of persons and rooms.
             if isinstance(identifier, SlackPerson):
-                log.debug(f"Someone mentioned user {identifier}")
-                mentioned.append(identifier)
-                text = text.replace(word, f"{identifier}")
+                log.debug("Someone mentioned user %s", identifier)
             elif isinstance(identifier, SlackRoom):
-                log.debug(f"Someone mentioned channel {identifier}")
-                mentioned.append(identifier)
-                text = text.replace(word, f"{identifier}")
+                log.debug("Someone mentioned channel %s", identifier)
+            else:
+                return word
+            mentioned.append(identifier)
+            return f"{identifier}"
 
+        text = SLACK_MENTION.sub(replace, text)
         return text, mentioned
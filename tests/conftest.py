@@ -1,4 +1,27 @@
 import os
 import sys
 
+import pytest
+
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+@pytest.fixture(autouse=True)
+def clear_slack_caches():
+    """Slack lookups are cached at module level, start every test from a cold cache."""
+    from slackv3.person import CHANNEL_INFO_CACHE, USER_INFO_CACHE, USERS_INDEX_CACHE
+    from slackv3.room import (
+        CHANNEL_ID_CACHE,
+        MISSING_CHANNEL_CACHE,
+        MISSING_ROOM_CACHE,
+        ROOM_INFO_CACHE,
+    )
+
+    USER_INFO_CACHE.clear()
+    CHANNEL_INFO_CACHE.clear()
+    USERS_INDEX_CACHE.clear()
+    CHANNEL_ID_CACHE.clear()
+    MISSING_CHANNEL_CACHE.clear()
+    MISSING_ROOM_CACHE.clear()
+    ROOM_INFO_CACHE.clear()
+    yield
@@ -0,0 +1,43 @@
+import logging
+import threading
+import unittest
+
+from slackv3.lib import TTLCache
+
+log = logging.getLogger(__name__)
+
+
+class TTLCacheTests(unittest.TestCase):
+    def test_peek_does_not_load(self):
+        cache = TTLCache(ttl=60)
+        self.assertIsNone(cache.peek("general"))
+        cache.set("general", "C012AB3CD")
+        self.assertEqual(cache.peek("general"), "C012AB3CD")
+
+    def test_peek_ignores_expired_entries(self):
+        cache = TTLCache(ttl=0)
+        cache.set("general", "C012AB3CD")
+        self.assertIsNone(cache.peek("general"))
+
+    def test_invalidate_during_load_is_not_overwritten(self):
+        cache = TTLCache(ttl=60)
+        loading = threading.Event()
+        release = threading.Event()
+
+        def loader():
+            loading.set()
+            release.wait(5)
+            return "C012AB3CD"
+
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(cache.get("general", loader))
+        )
+        thread.start()
+        self.assertTrue(loading.wait(5))
+        cache.invalidate("general")
+        release.set()
+        thread.join(5)
+
+        self.assertEqual(result, ["C012AB3CD"])
+        self.assertIsNone(cache.peek("general"))
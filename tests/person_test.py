@@ -327,5 +327,30 @@ class SlackPersonTests(unittest.TestCase):
         self.assertTrue(self.p == self.another_p)
         self.assertFalse(self.p == "this is not a person")
 
+    def test_user_info_fetched_lazily(self):
+        SlackPerson(self.webclient, userid=self.userid, channelid=self.channelid)
+        self.webclient.users_info.assert_not_called()
+        self.webclient.conversations_info.assert_not_called()
+
     def test_hash(self):
         self.assertEqual(hash(self.p), hash(self.p.userid))
+
+    def test_user_info_shared_between_instances(self):
+        self.assertEqual(
+            SlackPerson(self.webclient, userid=self.userid).username, "spengler"
+        )
+        self.assertEqual(
+            SlackPerson(self.webclient, userid=self.userid).fullname, "Egon Spengler"
+        )
+        self.webclient.users_info.assert_called_once_with(user=self.userid)
+
+    def test_user_not_found_is_not_cached(self):
+        self.webclient.users_info.return_value = SlackPersonTests.USER_NOT_FOUND
+        for _ in range(2):
+            self.assertEqual(
+                SlackPerson(self.webclient, userid=self.userid).username, ""
+            )
+        self.assertEqual(self.webclient.users_info.call_count, 2)
+
+    def test_not_equal(self):
+        self.assertFalse(self.p == SlackPerson(self.webclient, userid="W0123ABCD"))
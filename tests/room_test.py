@@ -2,8 +2,15 @@ import logging
 import unittest
 
 import pytest
+from errbot.backends.base import (
+    RoomDoesNotExistError,
+    RoomError,
+    UserDoesNotExistError,
+)
+from mock import MagicMock
+from slack_sdk.errors import SlackApiError
 
-from slackv3.room import SlackRoom
+from slackv3.room import ROOM_INFO_CACHE, SlackRoom, SlackRoomBot, SlackRoomOccupant
 
 log = logging.getLogger(__name__)
 
@@ -13,3 +20,293 @@ class SlackRoomTests(unittest.TestCase):
         with pytest.raises(ValueError) as excinfo:
             SlackRoom()
         assert "A name or channelid is required to create a Room." in str(excinfo.value)
+
+    def test_channel_name_resolution_is_cached(self):
+        webclient = MagicMock()
+        webclient.conversations_list.return_value = {
+            "ok": True,
+            "channels": [{"id": "C012AB3CD", "name": "general"}],
+            "response_metadata": {"next_cursor": ""},
+        }
+        room = SlackRoom(webclient=webclient, channelid="C012AB3CD")
+        self.assertEqual(room._channelname_to_id("general"), "C012AB3CD")
+        self.assertEqual(room._channelname_to_id("general"), "C012AB3CD")
+        webclient.conversations_list.assert_called_once()
+
+    def test_channel_name_resolution_walks_pages(self):
+        webclient = MagicMock()
+        webclient.conversations_list.side_effect = [
+            {
+                "ok": True,
+                "channels": [{"id": "C012AB3CD", "name": "general"}],
+                "response_metadata": {"next_cursor": "page2"},
+            },
+            {
+                "ok": True,
+                "channels": [{"id": "C0XXXXY6P", "name": "random"}],
+                "response_metadata": {"next_cursor": ""},
+            },
+        ]
+        room = SlackRoom(webclient=webclient, channelid="C012AB3CD")
+        self.assertEqual(room._channelname_to_id("random"), "C0XXXXY6P")
+        self.assertEqual(webclient.conversations_list.call_count, 2)
+
+    def test_channel_name_resolution_stops_at_match(self):
+        webclient = MagicMock()
+        webclient.conversations_list.return_value = {
+            "ok": True,
+            "channels": [{"id": "C012AB3CD", "name": "general"}],
+            "response_metadata": {"next_cursor": "page2"},
+        }
+        room = SlackRoom(webclient=webclient, channelid="C012AB3CD")
+        self.assertEqual(room._channelname_to_id("general"), "C012AB3CD")
+        webclient.conversations_list.assert_called_once()
+
+    def test_unknown_channel_name_is_cached(self):
+        webclient = MagicMock()
+        webclient.conversations_list.return_value = {
+            "ok": True,
+            "channels": [{"id": "C012AB3CD", "name": "general"}],
+            "response_metadata": {"next_cursor": ""},
+        }
+        room = SlackRoom(webclient=webclient, channelid="C012AB3CD")
+        for _ in range(2):
+            with self.assertRaises(RoomDoesNotExistError):
+                room._channelname_to_id("gozer")
+        types = [c.kwargs["types"] for c in webclient.conversations_list.call_args_list]
+        self.assertEqual(types[0], "public_channel")
+        self.assertCountEqual(types[1:], ["private_channel", "mpim"])
+
+    def test_room_name_is_resolved_without_hash(self):
+        webclient = MagicMock()
+        webclient.conversations_list.return_value = {
+            "ok": True,
+            "channels": [{"id": "C012AB3CD", "name": "general"}],
+            "response_metadata": {"next_cursor": ""},
+        }
+        room = SlackRoom(webclient=webclient, name="#general")
+        self.assertEqual(room.id, "C012AB3CD")
+
+    def test_invite_reuses_users_index(self):
+        webclient = MagicMock()
+        webclient.users_list.return_value = {
+            "ok": True,
+            "members": [{"id": "W012A3CDE", "name": "spengler"}],
+            "response_metadata": {"next_cursor": ""},
+        }
+        webclient.conversations_invite.return_value = {"ok": True}
+        room = SlackRoom(webclient=webclient, channelid="C012AB3CD", bot=MagicMock())
+        ROOM_INFO_CACHE.set("C012AB3CD", {"id": "C012AB3CD", "name": "general"})
+
+        room.invite("spengler")
+        room.invite("spengler")
+
+        webclient.users_list.assert_called_once()
+        webclient.conversations_invite.assert_called_with(
+            channel="C012AB3CD", users="W012A3CDE", force=True
+        )
+
+    def test_invite_batches_users(self):
+        webclient = MagicMock()
+        webclient.users_list.return_value = {
+            "ok": True,
+            "members": [
+                {"id": "W012A3CDE", "name": "spengler"},
+                {"id": "W0123ABCD", "name": "venkman"},
+            ],
+            "response_metadata": {"next_cursor": ""},
+        }
+        webclient.conversations_invite.return_value = {
+            "ok": True,
+            "errors": [
+                {"user": "W0123ABCD", "ok": False, "error": "already_in_channel"}
+            ],
+        }
+        room = SlackRoom(webclient=webclient, channelid="C012AB3CD", bot=MagicMock())
+        ROOM_INFO_CACHE.set("C012AB3CD", {"id": "C012AB3CD", "name": "general"})
+
+        room.invite("spengler", "venkman")
+
+        webclient.conversations_invite.assert_called_once_with(
+            channel="C012AB3CD", users="W012A3CDE,W0123ABCD", force=True
+        )
+
+    def test_invite_as_bot_user(self):
+        webclient = MagicMock()
+        webclient.users_list.return_value = {
+            "ok": True,
+            "members": [{"id": "W012A3CDE", "name": "spengler"}],
+            "response_metadata": {"next_cursor": ""},
+        }
+        webclient.conversations_invite.side_effect = SlackApiError(
+            "user_is_bot", {"ok": False, "error": "user_is_bot"}
+        )
+        room = SlackRoom(webclient=webclient, channelid="C012AB3CD", bot=MagicMock())
+        ROOM_INFO_CACHE.set("C012AB3CD", {"id": "C012AB3CD", "name": "general"})
+
+        with pytest.raises(RoomError):
+            room.invite("spengler")
+
+    def test_invite_unknown_user(self):
+        webclient = MagicMock()
+        webclient.users_list.return_value = {
+            "ok": True,
+            "members": [],
+            "response_metadata": {"next_cursor": ""},
+        }
+        room = SlackRoom(webclient=webclient, channelid="C012AB3CD", bot=MagicMock())
+        with pytest.raises(UserDoesNotExistError):
+            room.invite("spengler")
+
+    def test_channel_info_fetched_once(self):
+        webclient = MagicMock()
+        webclient.conversations_info.return_value = {
+            "ok": True,
+            "channel": {
+                "id": "C012AB3CD",
+                "name": "general",
+                "is_private": False,
+                "topic": {"value": "For public discussion of generalities"},
+                "purpose": {"value": "This part of the workspace is for fun."},
+            },
+        }
+        room = SlackRoom(webclient=webclient, channelid="C012AB3CD")
+        webclient.conversations_info.assert_not_called()
+
+        self.assertEqual(room.name, "general")
+        self.assertEqual(room.topic, "For public discussion of generalities")
+        self.assertEqual(room.purpose, "This part of the workspace is for fun.")
+        self.assertFalse(room.private)
+        webclient.conversations_info.assert_called_once_with(channel="C012AB3CD")
+
+        other = SlackRoom(webclient=webclient, channelid="C012AB3CD")
+        self.assertEqual(other.name, "general")
+        webclient.conversations_info.assert_called_once()
+
+        self.assertEqual(room._channelname_to_id("general"), "C012AB3CD")
+        webclient.conversations_list.assert_not_called()
+
+    def test_missing_channel_info_is_cached(self):
+        webclient = MagicMock()
+        webclient.conversations_info.side_effect = SlackApiError(
+            "channel_not_found", {"ok": False, "error": "channel_not_found"}
+        )
+        room = SlackRoom(webclient=webclient, channelid="C012AB3CD")
+        for _ in range(2):
+            self.assertRaises(RoomDoesNotExistError, getattr, room, "name")
+        self.assertIsNone(room.topic)
+        webclient.conversations_info.assert_called_once_with(channel="C012AB3CD")
+
+    def test_failed_channel_info_is_not_cached(self):
+        webclient = MagicMock()
+        webclient.conversations_info.side_effect = SlackApiError(
+            "ratelimited", {"ok": False, "error": "ratelimited"}
+        )
+        room = SlackRoom(webclient=webclient, channelid="C012AB3CD")
+        for _ in range(2):
+            self.assertRaises(SlackApiError, getattr, room, "name")
+        self.assertEqual(webclient.conversations_info.call_count, 2)
+
+    def test_create_remembers_new_channel(self):
+        webclient = MagicMock()
+        webclient.conversations_list.return_value = {
+            "ok": True,
+            "channels": [],
+            "response_metadata": {"next_cursor": ""},
+        }
+        bot = MagicMock()
+        bot.slack_web.conversations_create.return_value = {
+            "ok": True,
+            "channel": {"id": "C0NEW1234", "name": "ecto-1"},
+        }
+        room = SlackRoom(webclient=webclient, name="ecto-1", bot=bot)
+        with self.assertRaises(RoomDoesNotExistError):
+            room._channelname_to_id("ecto-1")
+
+        room.create()
+
+        self.assertEqual(room.id, "C0NEW1234")
+        self.assertEqual(str(room), "<#C0NEW1234|ecto-1>")
+        self.assertEqual(room._channelname_to_id("ecto-1"), "C0NEW1234")
+        bot.slack_web.conversations_create.assert_called_once_with(name="ecto-1")
+
+    def test_occupants(self):
+        webclient = MagicMock()
+        webclient.conversations_members.return_value = {
+            "ok": True,
+            "members": ["W012A3CDE", "W0123ABCD"],
+            "response_metadata": {"next_cursor": ""},
+        }
+        webclient.users_info.return_value = {
+            "ok": True,
+            "user": {"profile": {"display_name": "spengler"}},
+        }
+        room = SlackRoom(webclient=webclient, channelid="C012AB3CD")
+
+        occupants = room.occupants
+
+        self.assertEqual(
+            [occupant.userid for occupant in occupants], ["W012A3CDE", "W0123ABCD"]
+        )
+        webclient.users_info.assert_not_called()
+        self.assertEqual(
+            [occupant.username for occupant in occupants], ["spengler", "spengler"]
+        )
+        self.assertEqual(webclient.users_info.call_count, 2)
+        self.assertTrue(all(occupant.room is room for occupant in occupants))
+
+    def test_channel_name_resolution_indexes_page(self):
+        webclient = MagicMock()
+        webclient.conversations_list.return_value = {
+            "ok": True,
+            "channels": [
+                {"id": "C012AB3CD", "name": "general"},
+                {"id": "C0XXXXY6P", "name": "random"},
+            ],
+            "response_metadata": {"next_cursor": ""},
+        }
+        room = SlackRoom(webclient=webclient, channelid="C012AB3CD")
+        self.assertEqual(room._channelname_to_id("general"), "C012AB3CD")
+        self.assertEqual(room._channelname_to_id("random"), "C0XXXXY6P")
+        webclient.conversations_list.assert_called_once()
+
+    def test_exists_matches_channel_id(self):
+        bot = MagicMock()
+        bot.channels.return_value = [{"id": "C012AB3CD", "name": "renamed"}]
+        room = SlackRoom(webclient=MagicMock(), channelid="C012AB3CD", bot=bot)
+
+        self.assertTrue(room.exists)
+        self.assertTrue(room.joined)
+        bot.channels.assert_called_with(joined_only=True)
+
+    def test_channel_name_resolution_searches_other_types(self):
+        def conversations_list(types, **kwargs):
+            channels = {
+                "public_channel": [{"id": "C012AB3CD", "name": "general"}],
+                "private_channel": [{"id": "G012AB3CD", "name": "firehouse"}],
+                "mpim": [],
+            }[types]
+            return {
+                "ok": True,
+                "channels": channels,
+                "response_metadata": {"next_cursor": ""},
+            }
+
+        webclient = MagicMock()
+        webclient.conversations_list.side_effect = conversations_list
+        room = SlackRoom(webclient=webclient, channelid="C012AB3CD")
+        self.assertEqual(room._channelname_to_id("firehouse"), "G012AB3CD")
+
+    def test_occupants_are_hashable(self):
+        first = SlackRoomOccupant(MagicMock(), "W012A3CDE", "C012AB3CD", None)
+        second = SlackRoomOccupant(MagicMock(), "W012A3CDE", "C012AB3CD", None)
+        other_room = SlackRoomOccupant(MagicMock(), "W012A3CDE", "C0XXXXY6P", None)
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other_room)
+        self.assertEqual(len({first, second, other_room}), 2)
+
+    def test_room_bots_compare_equal(self):
+        first = SlackRoomBot(MagicMock(), "B04HMXXXX", "ecto-1", "C012AB3CD", None)
+        second = SlackRoomBot(MagicMock(), "B04HMXXXX", "ecto-1", "C012AB3CD", None)
+        self.assertEqual(first, second)
+        self.assertEqual(len({first, second}), 1)
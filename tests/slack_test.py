@@ -1,13 +1,26 @@
+import importlib
+import io
 import json
 import logging
 import os
-import sys
+import shutil
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import mkdtemp
-
-from errbot.backends.base import Message
+from types import SimpleNamespace
+
+from errbot.backends.base import (
+    STREAM_SUCCESSFULLY_TRANSFERED,
+    Card,
+    Message,
+    Stream,
+    UserDoesNotExistError,
+    UserNotUniqueError,
+)
 from errbot.bootstrap import bot_config_defaults
 from mock import MagicMock
+from slack_sdk.errors import SlackApiError
 
 
 log = logging.getLogger(__name__)
@@ -243,13 +256,21 @@ SUCCESSFUL_UPDATE_MESSAGE_RESPONSE = json.loads(
 
 
 class SlackTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Nothing is persisted to the bot's data directory, share one per class.
+        cls.tempdir = mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, cls.tempdir, ignore_errors=True)
+        template = importlib.import_module("errbot.config-template")
+        cls.config_template = {
+            k: v for k, v in vars(template).items() if not k.startswith("__")
+        }
+
     def setUp(self):
         # make up a config.
-        tempdir = mkdtemp()
+        tempdir = self.tempdir
         # reset the config every time
-        sys.modules.pop("errbot.config-template", None)
-        __import__("errbot.config-template")
-        config = sys.modules["errbot.config-template"]
+        config = SimpleNamespace(**self.config_template)
         bot_config_defaults(config)
         config.BOT_DATA_DIR = tempdir
         config.BOT_LOG_FILE = os.path.join(tempdir, "log.txt")
@@ -336,6 +357,10 @@ class SlackTests(unittest.TestCase):
         assert parts[1].count("```") == 2
         assert parts[1].endswith("```\n")
 
+        test_body = "```\nghost\n``` trap"
+        parts = self.slack.prepare_message_body(test_body, 8)
+        assert parts == ["```\nghos\n```\n", "```\nt\n``` tr", "ap"]
+
     def test_extract_identifiers(self):
         extract_from = self.slack.extract_identifiers_from_string
 
@@ -357,6 +382,10 @@ class SlackTests(unittest.TestCase):
 
         self.assertEqual(extract_from("#general"), (None, None, "general", None))
 
+        self.assertEqual(
+            extract_from("<#C12345|general>"), (None, None, "general", "C12345")
+        )
+
         with self.assertRaises(ValueError):
             extract_from("<@U12345|UName>")
 
@@ -474,32 +503,29 @@ class SlackTests(unittest.TestCase):
         )
 
         mentions = self.slack.process_mentions
+        expected = {
+            userid: self.slack.build_identifier(f"<@{userid}>")
+            for userid in ("U1", "U2", "U3", "U12345", "U56789", "UABCDE", "UFGHIJ")
+        }
 
         self.assertEqual(
             mentions("<@U1><@U2><@U3>"),
             (
                 "<@U1><@U2><@U3>",
-                [
-                    self.slack.build_identifier("<@U1>"),
-                    self.slack.build_identifier("<@U2>"),
-                    self.slack.build_identifier("<@U3>"),
-                ],
+                [expected["U1"], expected["U2"], expected["U3"]],
             ),
         )
 
         self.assertEqual(
             mentions("Is <@U12345>: here?"),
-            ("Is <@U12345>: here?", [self.slack.build_identifier("<@U12345>")]),
+            ("Is <@U12345>: here?", [expected["U12345"]]),
         )
 
         self.assertEqual(
             mentions("<@U12345> told me about @a and <@U56789> told me about @b"),
             (
                 "<@U12345> told me about @a and <@U56789> told me about @b",
-                [
-                    self.slack.build_identifier("<@U12345>"),
-                    self.slack.build_identifier("<@U56789>"),
-                ],
+                [expected["U12345"], expected["U56789"]],
             ),
         )
 
@@ -507,10 +533,7 @@ class SlackTests(unittest.TestCase):
             mentions("!these!<@UABCDE>!mentions! will !still!<@UFGHIJ>!work!"),
             (
                 "!these!<@UABCDE>!mentions! will !still!<@UFGHIJ>!work!",
-                [
-                    self.slack.build_identifier("<@UABCDE>"),
-                    self.slack.build_identifier("<@UFGHIJ>"),
-                ],
+                [expected["UABCDE"], expected["UFGHIJ"]],
             ),
         )
 
@@ -561,3 +584,501 @@ class SlackTests(unittest.TestCase):
 
         self.assertEqual(resp.body, EXAMPLE_UPDATE_MESSAGE.body)
         self.assertEqual(len(resp.extras["ts"]), 1)
+
+    def test_update_message_deletes_extra_parts(self):
+        self.slack.slack_web = MagicMock()
+        self.slack.slack_web.chat_update.return_value = (
+            SUCCESSFUL_UPDATE_MESSAGE_RESPONSE
+        )
+        mocked_plugin_manager = MagicMock()
+        mocked_plugin_manager.get_all_active_plugins.return_value = []
+        self.slack.attach_plugin_manager(mocked_plugin_manager)
+        msg = Message(
+            body="Here's a message for you",
+            to=MOCKED_PERSON,
+            extras={
+                "ts": ["1401383885.000061", "1401383885.000062", "1401383885.000063"]
+            },
+        )
+
+        resp = self.slack.update_message(msg)
+
+        self.assertEqual(len(resp.extras["ts"]), 1)
+        deleted = [
+            c.kwargs["ts"] for c in self.slack.slack_web.chat_delete.call_args_list
+        ]
+        self.assertCountEqual(deleted, ["1401383885.000062", "1401383885.000063"])
+
+    def test_username_to_userid(self):
+        self.slack.auth = {"user": "errbot"}
+        self.slack.slack_web.users_list.return_value = {
+            "ok": True,
+            "members": [
+                {"id": "W012A3CDE", "name": "spengler"},
+                {"id": "W0123ABCD", "name": "venkman"},
+                {"id": "W0123EFGH", "name": "venkman"},
+            ],
+            "response_metadata": {"next_cursor": ""},
+        }
+
+        self.assertEqual(self.slack.username_to_userid("@spengler"), "W012A3CDE")
+        self.assertEqual(self.slack.username_to_userid("spengler"), "W012A3CDE")
+        with self.assertRaises(UserNotUniqueError):
+            self.slack.username_to_userid("venkman")
+        with self.assertRaises(UserDoesNotExistError):
+            self.slack.username_to_userid("stantz")
+        self.slack.slack_web.users_list.assert_called_once()
+
+    def test_channels_paginates(self):
+        self.slack.slack_web.conversations_list.side_effect = [
+            {
+                "ok": True,
+                "channels": [{"id": "C012AB3CD", "name": "general", "is_member": True}],
+                "response_metadata": {"next_cursor": "page2"},
+            },
+            {
+                "ok": True,
+                "channels": [{"id": "C0XXXXY6P", "name": "random", "is_member": False}],
+                "response_metadata": {"next_cursor": ""},
+            },
+        ]
+
+        channels = self.slack.channels(joined_only=True)
+
+        self.assertEqual([channel["name"] for channel in channels], ["general"])
+        self.assertEqual(self.slack.slack_web.conversations_list.call_count, 2)
+
+        room = self.slack.query_room("random")
+        self.assertEqual(room.id, "C0XXXXY6P")
+        self.assertEqual(self.slack.slack_web.conversations_list.call_count, 2)
+
+    def test_query_room_by_link(self):
+        room = self.slack.query_room("<#C012AB3CD>")
+        self.assertEqual(room.id, "C012AB3CD")
+        self.assertIs(self.slack.query_room("C012AB3CD"), room)
+
+    def test_event_dispatch(self):
+        self.assertEqual(
+            self.slack._event_handlers["message"], self.slack._handle_message
+        )
+        self.assertEqual(
+            self.slack._rtm_event_handlers["message"], self.slack._rtm_handle_message
+        )
+        self.assertIsNone(
+            self.slack._generic_wrapper({"event": {"type": "unsupported_event"}})
+        )
+
+    def test_get_im_channel_is_cached(self):
+        self.slack.slack_web.conversations_open.return_value = CONVERSATION_OPEN_OK
+        self.assertEqual(self.slack.get_im_channel("W012A3CDE"), "C012AB3CD")
+        self.assertEqual(self.slack.get_im_channel("W012A3CDE"), "C012AB3CD")
+        self.slack.slack_web.conversations_open.assert_called_once_with(
+            users="W012A3CDE"
+        )
+
+    def test_get_im_channel_concurrent_calls_share_request(self):
+        opening = threading.Event()
+        release = threading.Event()
+
+        def conversations_open(users):
+            opening.set()
+            release.wait(5)
+            return CONVERSATION_OPEN_OK
+
+        self.slack.slack_web.conversations_open.side_effect = conversations_open
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            first = executor.submit(self.slack.get_im_channel, "W012A3CDE")
+            opening.wait(5)
+            others = [
+                executor.submit(self.slack.get_im_channel, "W012A3CDE")
+                for _ in range(3)
+            ]
+            release.set()
+            results = [f.result() for f in [first] + others]
+
+        self.assertEqual(results, ["C012AB3CD"] * 4)
+        self.slack.slack_web.conversations_open.assert_called_once_with(
+            users="W012A3CDE"
+        )
+
+    def test_get_im_channel_for_bot_is_cached(self):
+        self.slack.slack_web.conversations_open.side_effect = SlackApiError(
+            "cannot_dm_bot", {"ok": False, "error": "cannot_dm_bot"}
+        )
+        self.assertIsNone(self.slack.get_im_channel("B012A3CDE"))
+        self.assertIsNone(self.slack.get_im_channel("B012A3CDE"))
+        self.slack.slack_web.conversations_open.assert_called_once_with(
+            users="B012A3CDE"
+        )
+
+    def test_bot_mention_does_not_reopen_im_channel(self):
+        self.slack.slack_web.conversations_open.side_effect = SlackApiError(
+            "cannot_dm_bot", {"ok": False, "error": "cannot_dm_bot"}
+        )
+
+        first = self.slack.build_identifier("<@B012A3CDE>")
+        self.slack.slack_web.conversations_open.reset_mock()
+        second = self.slack.build_identifier("<@B012A3CDE>")
+
+        self.slack.slack_web.conversations_open.assert_not_called()
+        self.assertEqual(first, second)
+        self.assertIsNone(second.channelid)
+
+    def test_update_alternate_prefixes(self):
+        self.slack.auth = {"user": "errbot"}
+        self.slack.bot_config.BOT_ALT_PREFIXES = ("spengler", "venkman")
+        self.slack.bot_config.BOT_ALT_PREFIX_CASEINSENSITIVE = True
+        self.slack.slack_web.users_list.return_value = {
+            "ok": True,
+            "members": [
+                {"id": "W012A3CDE", "name": "spengler"},
+                {"id": "W0123ABCD", "name": "venkman"},
+            ],
+            "response_metadata": {"next_cursor": ""},
+        }
+
+        self.slack.update_alternate_prefixes()
+
+        self.assertEqual(
+            self.slack.bot_alt_prefixes,
+            ("<@w012a3cde>", "<@w0123abcd>", "spengler", "venkman"),
+        )
+        self.slack.slack_web.users_list.assert_called_once()
+
+        # Reconnecting with the same settings reuses the converted prefixes.
+        self.slack.username_to_userid = MagicMock()
+        self.slack.update_alternate_prefixes()
+        self.slack.username_to_userid.assert_not_called()
+
+    def test_occupants_share_room(self):
+        first = slack.slackv3.SlackRoomOccupant(
+            None, "W012A3CDE", "C012AB3CD", self.slack
+        )
+        second = slack.slackv3.SlackRoomOccupant(
+            None, "W0123ABCD", "C012AB3CD", self.slack
+        )
+        self.assertIs(first.room, second.room)
+        self.assertIs(self.slack.get_room("C012AB3CD"), first.room)
+
+    def test_setup_event_callbacks(self):
+        self.slack.slack_events = MagicMock()
+        self.slack.connect_callback = MagicMock()
+
+        self.slack._setup_event_callbacks()
+
+        registered = [c.args[0] for c in self.slack.slack_events.on.call_args_list]
+        self.assertEqual(
+            registered,
+            [
+                "channel_archive",
+                "channel_deleted",
+                "channel_rename",
+                "channel_unarchive",
+                "group_archive",
+                "group_deleted",
+                "group_rename",
+                "group_unarchive",
+                "member_joined_channel",
+                "message",
+                "reaction_added",
+                "reaction_removed",
+                "team_join",
+                "user_change",
+            ],
+        )
+        self.slack.connect_callback.assert_called_once()
+
+    def test_user_change_refreshes_caches(self):
+        caches = slack.person
+        caches.USER_INFO_CACHE.set("W012A3CDE", {"display_name": "spengler"})
+        caches.USERS_INDEX_CACHE.set("users", {"spengler": ("W012A3CDE",)})
+
+        self.slack._generic_wrapper(
+            {
+                "event": {
+                    "type": "user_change",
+                    "user": {"id": "W012A3CDE", "name": "egon"},
+                }
+            }
+        )
+
+        self.assertIsNone(caches.USER_INFO_CACHE.peek("W012A3CDE"))
+        self.assertEqual(
+            caches.USERS_INDEX_CACHE.peek("users"), {"egon": ("W012A3CDE",)}
+        )
+
+    def test_team_join_refreshes_users_index(self):
+        caches = slack.person
+        caches.USERS_INDEX_CACHE.set("users", {"spengler": ("W012A3CDE",)})
+
+        self.slack._generic_wrapper(
+            {
+                "event": {
+                    "type": "team_join",
+                    "user": {"id": "W0123ABCD", "name": "venkman"},
+                }
+            }
+        )
+
+        self.assertIsNone(caches.USERS_INDEX_CACHE.peek("users"))
+
+    def test_channel_rename_refreshes_caches(self):
+        caches = slack.room
+        caches.ROOM_INFO_CACHE.set("C012AB3CD", {"id": "C012AB3CD", "name": "general"})
+        caches.CHANNEL_ID_CACHE.set("general", "C012AB3CD")
+
+        self.slack._generic_wrapper(
+            {
+                "event": {
+                    "type": "channel_rename",
+                    "channel": {"id": "C012AB3CD", "name": "firehouse", "created": 0},
+                }
+            }
+        )
+
+        self.assertIsNone(caches.ROOM_INFO_CACHE.peek("C012AB3CD"))
+        self.assertIsNone(caches.CHANNEL_ID_CACHE.peek("general"))
+        self.assertEqual(caches.CHANNEL_ID_CACHE.peek("firehouse"), "C012AB3CD")
+
+    def test_slack_upload(self):
+        self.slack.slack_web.files_getUploadURLExternal.return_value = {
+            "ok": True,
+            "upload_url": "https://files.slack.com/upload/v1/ABC",
+            "file_id": "F123ABC456",
+        }
+        self.slack.slack_web.files_completeUploadExternal.return_value = {"ok": True}
+        self.slack._put_upload = MagicMock()
+        user = MagicMock()
+        user.channelid = "C012AB3CD"
+        stream = Stream(user, io.BytesIO(b"ghostbusters"), "report.txt")
+
+        self.slack._slack_upload(stream)
+
+        self.slack.slack_web.files_getUploadURLExternal.assert_called_once_with(
+            filename="report.txt", length=12
+        )
+        self.slack._put_upload.assert_called_once_with(
+            "https://files.slack.com/upload/v1/ABC", stream, 12
+        )
+        self.slack.slack_web.files_completeUploadExternal.assert_called_once_with(
+            files=[{"id": "F123ABC456", "title": "report.txt"}],
+            channel_id="C012AB3CD",
+        )
+        self.assertEqual(stream.status, STREAM_SUCCESSFULLY_TRANSFERED)
+
+    def test_slack_upload_measures_unseekable_stream(self):
+        class Unseekable(io.RawIOBase):
+            def __init__(self, data):
+                self._data = io.BytesIO(data)
+
+            def readable(self):
+                return True
+
+            def readinto(self, buffer):
+                return self._data.readinto(buffer)
+
+        self.slack.slack_web.files_getUploadURLExternal.return_value = {
+            "ok": True,
+            "upload_url": "https://files.slack.com/upload/v1/ABC",
+            "file_id": "F123ABC456",
+        }
+        self.slack.slack_web.files_completeUploadExternal.return_value = {"ok": True}
+        uploaded = []
+        self.slack._put_upload = lambda url, body, length: uploaded.append(
+            (body.read(), length)
+        )
+        user = MagicMock()
+        user.channelid = "C012AB3CD"
+        stream = Stream(user, Unseekable(b"ghostbusters"), "report.txt", size=3)
+
+        self.slack._slack_upload(stream)
+
+        self.slack.slack_web.files_getUploadURLExternal.assert_called_once_with(
+            filename="report.txt", length=12
+        )
+        self.assertEqual(uploaded, [(b"ghostbusters", 12)])
+        self.assertEqual(stream.status, STREAM_SUCCESSFULLY_TRANSFERED)
+
+    def test_slack_upload_to_room_uses_channel_id(self):
+        self.slack.slack_web.files_getUploadURLExternal.return_value = {
+            "ok": True,
+            "upload_url": "https://files.slack.com/upload/v1/ABC",
+            "file_id": "F123ABC456",
+        }
+        self.slack.slack_web.files_completeUploadExternal.return_value = {"ok": True}
+        self.slack._put_upload = MagicMock()
+        room = self.slack.get_room("C012AB3CD")
+        stream = Stream(room, io.BytesIO(b"ghostbusters"), "report.txt")
+
+        self.slack._slack_upload(stream)
+
+        self.slack.slack_web.files_completeUploadExternal.assert_called_once_with(
+            files=[{"id": "F123ABC456", "title": "report.txt"}],
+            channel_id="C012AB3CD",
+        )
+
+    def test_send_stream_request_releases_upload_slot(self):
+        self.slack._upload_slots = threading.BoundedSemaphore(1)
+        uploaded = threading.Event()
+        self.slack._slack_upload = lambda stream: uploaded.set()
+        user = MagicMock()
+
+        for _ in range(2):
+            uploaded.clear()
+            self.slack.send_stream_request(user, io.BytesIO(b"ghostbusters"), "a.txt")
+            self.assertTrue(uploaded.wait(5))
+
+    def test_shutdown_runs_once(self):
+        self.slack.close_storage = MagicMock()
+        self.slack.plugin_manager = MagicMock()
+        self.slack.repo_manager = MagicMock()
+        # Plugins sending on deactivation need the send executor to still be running.
+        send = self.slack._send_executor
+        self.slack.plugin_manager.shutdown.side_effect = lambda: send.submit(
+            lambda: None
+        ).result()
+
+        self.slack.shutdown()
+        self.slack.shutdown()
+
+        self.slack.plugin_manager.shutdown.assert_called_once()
+        self.slack.close_storage.assert_called_once()
+        with self.assertRaises(RuntimeError):
+            self.slack._send_executor.submit(lambda: None)
+
+    def test_rooms_reuse_rooms(self):
+        self.slack.channels = MagicMock(
+            return_value=[{"id": "C012AB3CD", "name": "general"}]
+        )
+        room = self.slack.get_room("C012AB3CD")
+        self.assertEqual(self.slack.rooms(), [room])
+        self.assertIs(self.slack.rooms()[0], room)
+
+    def test_backend_is_hashable(self):
+        self.assertEqual(len({self.slack, self.slack}), 1)
+
+    def test_message_from_self_is_ignored(self):
+        self.slack.bot_identifier.userid = "W012A3CDE"
+        self.slack.process_mentions = MagicMock()
+        event = {
+            "channel": "C0XXXXY6P",
+            "ts": "1444416645.000641",
+            "type": "message",
+            "text": "Hello <@W0123ABCD>",
+            "user": "W012A3CDE",
+        }
+
+        self.slack._handle_message(MagicMock(), event)
+
+        self.assertEqual(self.slack.test_msgs, [])
+        self.slack.process_mentions.assert_not_called()
+
+    def test_room_message_shares_room(self):
+        event = {
+            "channel": "C0XXXXY6P",
+            "ts": "1444416645.000641",
+            "type": "message",
+            "text": "Hello",
+            "user": "W012A3CDE",
+        }
+
+        self.slack._handle_message(self.slack.slack_web, event)
+        self.slack._handle_message(self.slack.slack_web, event)
+
+        first, second = self.slack.test_msgs
+        self.assertIs(first.to, first.frm.room)
+        self.assertIs(first.to, second.to)
+
+    def test_room_bot_messages_share_sender(self):
+        event = {
+            "channel": "C0XXXXY6P",
+            "ts": "1444416645.000641",
+            "type": "message",
+            "subtype": "bot_message",
+            "text": "Build passed",
+            "bot_id": "B04HMXXXX",
+            "username": "ecto-1",
+        }
+
+        self.slack._handle_message(self.slack.slack_web, event)
+        self.slack._handle_message(self.slack.slack_web, event)
+
+        first, second = self.slack.test_msgs
+        self.assertIs(first.frm, second.frm)
+        self.assertIs(first.to, first.frm.room)
+
+    def test_add_reaction(self):
+        msg = Message("Who you gonna call?")
+        msg.to = MagicMock(channelid="C012AB3CD")
+        msg.extras["slack_event"] = {"ts": "1444416645.000641"}
+
+        self.slack.add_reaction(msg, "ghost")
+
+        self.slack.slack_web.reactions_add.assert_called_once_with(
+            channel="C012AB3CD", timestamp="1444416645.000641", name="ghost"
+        )
+
+    def test_add_reaction_twice_is_ignored(self):
+        self.slack.slack_web.reactions_add.side_effect = SlackApiError(
+            "already_reacted", {"ok": False, "error": "already_reacted"}
+        )
+        msg = Message("Who you gonna call?")
+        msg.to = MagicMock(channelid="C012AB3CD")
+        msg.extras["slack_event"] = {"ts": "1444416645.000641"}
+
+        self.slack.add_reaction(msg, "ghost")
+
+    def test_prefetch_im_channels(self):
+        self.slack.bot_identifier.userid = "W0000BOT1"
+        self.slack.slack_web.conversations_open.return_value = CONVERSATION_OPEN_OK
+
+        self.slack._prefetch_im_channels("<@W012A3CDE> <@W0123ABCD> <@W0000BOT1>")
+
+        self.assertEqual(
+            sorted(
+                call.kwargs["users"]
+                for call in self.slack.slack_web.conversations_open.call_args_list
+            ),
+            ["W0123ABCD", "W012A3CDE"],
+        )
+        self.slack.get_im_channel("W012A3CDE")
+        self.assertEqual(self.slack.slack_web.conversations_open.call_count, 2)
+
+    def test_send_card_in_thread(self):
+        parent = Message("Who you gonna call?")
+        parent.extras["slack_event"] = {"ts": "1444416645.000641"}
+        card = Card(
+            body="Ghostbusters!",
+            to=MagicMock(channelid="C012AB3CD"),
+            title="Answer",
+            parent=parent,
+        )
+        self.slack._prepare_message = MagicMock(return_value=("#general", "C012AB3CD"))
+
+        self.slack.send_card(card)
+
+        self.slack.slack_web.chat_postMessage.assert_called_once_with(
+            channel="C012AB3CD",
+            attachments=[{"title": "Answer", "text": "Ghostbusters!"}],
+            link_names="1",
+            as_user="true",
+            thread_ts="1444416645.000641",
+        )
+
+    def test_send_long_card_as_snippet(self):
+        body = "Who you gonna call?\n" * 500
+        card = Card(body=body, to=MagicMock(channelid="C012AB3CD"), title="Answer")
+        self.slack._prepare_message = MagicMock(return_value=("#general", "C012AB3CD"))
+        self.slack.card_snippet_parts = 2
+
+        self.slack.send_card(card)
+
+        self.slack.slack_web.chat_postMessage.assert_not_called()
+        self.slack.slack_web.files_upload_v2.assert_called_once_with(
+            channel="C012AB3CD",
+            content=body,
+            filename="message.md",
+            title="Answer",
+            initial_comment="Answer",
+            thread_ts=None,
+        )